@@ -1,14 +1,18 @@
 import logging
+from datetime import datetime
 from decimal import Decimal
+from http import HTTPStatus
 from typing import Annotated, Optional
 
-from fastapi import APIRouter, Depends, Request
-from pydantic import Field
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from pydantic import Field, field_validator, model_validator
 
 from blackledger import model, types
 from blackledger.db import queries
+from blackledger.db.pool import read_connection
+from blackledger.response import JSONResponse, export_response
 
-from ..search import SearchParams
+from ..search import SearchParams, decode_cursor, encode_cursor
 
 router = APIRouter(prefix="/accounts", tags=["accounts"])
 
@@ -32,19 +36,20 @@ class AccountParams(SearchParams):
 
 @router.get("", response_model=list[model.Account])
 async def search_accounts(
-    req: Request, params: Annotated[AccountParams, Depends(AccountParams)]
+    req: Request,
+    params: Annotated[AccountParams, Depends(AccountParams)],
 ):
     """
-    Search for and list accounts.
+    Search for and list accounts. When ordered by id, the Link header has the cursor
+    links (`_after` / `_before`) to the next and previous pages.
     """
-    query = req.app.sql.queries.SELECT(
-        "account", filters=params.select_filters(), **params.select_params()
-    )
-    async with req.app.pool.connection() as conn:
-        results = await req.app.sql.select_all(
-            conn, query, params.query_data(), Constructor=model.Account
-        )
-    return [account.model_dump(exclude_none=True) for account in results]
+    async with read_connection(req) as conn:
+        results = await queries.select_accounts(conn, req.app.sql, params)
+
+    response = JSONResponse(content=results)
+    if link := params.cursor_links(req.url, results):
+        response.headers["Link"] = link
+    return response
 
 
 @router.post("", response_model=model.Account)
@@ -62,25 +67,190 @@ async def save_account(req: Request, item: model.Account):
 
 @router.get("/balances", response_model=list[model.AccountBalances])
 async def search_account_balances(
-    req: Request, params: Annotated[AccountParams, Depends(AccountParams)]
+    req: Request,
+    params: Annotated[AccountParams, Depends(AccountParams)],
+    as_of: Annotated[Optional[datetime], Query()] = None,
 ):
     """
-    Search for accounts and list their balances.
+    Search for accounts and list their balances. If `as_of` is given, the balances
+    include only the transactions that are effective at or before that time.
     """
-    async with req.app.pool.connection() as conn:
-        results = await queries.select_balances(conn, req.app.sql, params)
+    async with read_connection(req) as conn:
+        results = await queries.select_balances(conn, req.app.sql, params, as_of=as_of)
+
+    return JSONResponse(content=account_balances(results))
+
+
+@router.get("/balances/rollup", response_model=list[model.AccountBalances])
+async def search_account_rollup_balances(
+    req: Request,
+    params: Annotated[AccountParams, Depends(AccountParams)],
+    as_of: Annotated[Optional[datetime], Query()] = None,
+):
+    """
+    Search for accounts and list their rolled-up balances: The balances of each account
+    include the balances of all of its descendant accounts (by `parent_id`). If `as_of`
+    is given, the balances include only the transactions that are effective at or
+    before that time.
+    """
+    async with read_connection(req) as conn:
+        results = await queries.select_balances(
+            conn, req.app.sql, params, as_of=as_of, rollup=True
+        )
 
+    return JSONResponse(content=account_balances(results))
+
+
+def account_balances(results: list[dict]) -> list[dict]:
+    """
+    Construct the AccountBalances rows directly from the balance query results (one row
+    per account and currency), so that they can be serialized as they are.
+    """
     balances = {}
     for result in results:
-        account = model.Account(**result)
-        if account.id not in balances:
-            balances[account.id] = model.AccountBalances(
-                account=account,
-                balances={},
-            )
+        if result["id"] not in balances:
+            balances[result["id"]] = {
+                "account": {
+                    field: result[field] for field in model.Account.model_fields
+                },
+                "balances": {},
+            }
         amount = (
             (result.get("dr") or Decimal(0)) - (result.get("cr") or Decimal(0))
-        ) * int(account.normal)
-        balances[account.id].balances[result["curr"]] = amount
+        ) * int(types.Normal(result["normal"]))
+        balances[result["id"]]["balances"][result["curr"]] = amount
 
     return list(balances.values())
+
+
+class RegisterParams(model.Model):
+    """
+    The account register params: Filters, and keyset paging on (effective, id). The
+    register is always in effective order, so it doesn't have _orderby or _offset.
+    """
+
+    curr: Optional[types.CurrencyCode] = None
+    # date range: from (inclusive) - to (exclusive)
+    effective_from: Optional[datetime] = None
+    effective_to: Optional[datetime] = None
+    limit: int = Field(default=100, gt=0, le=1000, alias="_limit")
+    after: Optional[str] = Field(default=None, alias="_after")
+    before: Optional[str] = Field(default=None, alias="_before")
+
+    @field_validator("after", "before")
+    @classmethod
+    def check_cursor(cls, value):
+        try:
+            effective, id = decode_cursor(value)
+            assert isinstance(effective, str) and isinstance(id, int)
+            datetime.fromisoformat(effective)
+        except Exception:
+            raise ValueError("invalid cursor")
+        return value
+
+    @model_validator(mode="after")
+    def check_cursor_params(self):
+        assert not (self.after and self.before), "use either _after or _before"
+        return self
+
+    def query_data(self) -> dict:
+        data = self.model_dump(include={"curr", "effective_from", "effective_to"})
+        data["_limit"] = self.limit
+        if self.after or self.before:
+            effective, id = decode_cursor(self.after or self.before)
+            data |= {
+                "cursor_effective": datetime.fromisoformat(effective),
+                "cursor_id": id,
+            }
+        return data
+
+    def query_shape(self) -> tuple:
+        return (
+            bool(self.curr),
+            bool(self.effective_from),
+            bool(self.effective_to),
+            bool(self.after),
+            bool(self.before),
+        )
+
+    def cursor_links(self, url, results: list) -> Optional[str]:
+        """
+        Return a Link header value with the "next" and "prev" cursor links for the given
+        results (in register order), or None if there are no such pages.
+        """
+        url = url.remove_query_params(["_after", "_before"])
+        links = []
+        if results and (self.before or len(results) >= self.limit):
+            last = results[-1]
+            cursor = encode_cursor([last["effective"], last["id"]])
+            links.append(f'<{url.include_query_params(_after=cursor)}>; rel="next"')
+        if results and (self.after or self.before):
+            first = results[0]
+            cursor = encode_cursor([first["effective"], first["id"]])
+            links.append(f'<{url.include_query_params(_before=cursor)}>; rel="prev"')
+        return ", ".join(links) or None
+
+
+@router.get("/{acct}/register", response_model=list[model.RegisterEntry])
+async def account_register(
+    req: Request,
+    acct: model.BigIDField,
+    params: Annotated[RegisterParams, Depends(RegisterParams)],
+):
+    """
+    The account register: The account's entries in effective order, each with its
+    transaction's posted time and memo, and the account's running balance in the entry's
+    currency after the entry. Filter with `curr` and `effective_from` /
+    `effective_to`, and page with the cursor links (`_after` / `_before`) in the Link
+    header. The running balances are the account's actual balances, whatever the
+    filters and page.
+    """
+    sql = req.app.sql
+    async with read_connection(req) as conn:
+        account = await queries.select_account(conn, sql, acct)
+        if account is None:
+            raise HTTPException(
+                status_code=HTTPStatus.NOT_FOUND,
+                detail=f"Account not found: {acct}",
+            )
+        results = await queries.select_register(conn, sql, account, params)
+
+    response = JSONResponse(content=results)
+    if link := params.cursor_links(req.url, results):
+        response.headers["Link"] = link
+    return response
+
+
+@router.get("/{acct}/export")
+async def export_account(
+    req: Request,
+    acct: model.BigIDField,
+    format: Annotated[types.ExportFormat, Query(alias="_format")] = (
+        types.ExportFormat.NDJSON
+    ),
+):
+    """
+    Export the account register: All the transactions in the account, with the
+    account's entries, in transaction order. The export is streamed as it is read from
+    the database, so there is no limit on its size.
+    """
+    sql = req.app.sql
+    async with read_connection(req) as conn:
+        account = await queries.select_account(conn, sql, acct)
+    if account is None:
+        raise HTTPException(
+            status_code=HTTPStatus.NOT_FOUND,
+            detail=f"Account not found: {acct}",
+        )
+
+    async def transactions():
+        async with read_connection(req) as conn:
+            async for tx in queries.stream_transactions(
+                conn,
+                sql,
+                ["e.ledger_id = :ledger_id", "e.acct = :acct"],
+                {"ledger_id": account["ledger_id"], "acct": acct},
+            ):
+                yield tx
+
+    return export_response(transactions(), format, f"account-{acct}")
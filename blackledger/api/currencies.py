@@ -4,6 +4,8 @@ from fastapi import APIRouter, Depends, Request
 
 from blackledger import model, types
 from blackledger.db import queries
+from blackledger.db.pool import read_connection
+from blackledger.response import JSONResponse
 
 from ..search import SearchParams
 
@@ -11,20 +13,28 @@ router = APIRouter(prefix="/currencies", tags=["currencies"])
 
 
 class CurrencyParams(SearchParams):
+    cursor_key = "code"
+    cursor_type = str
+
     code: Optional[types.CurrencyFilter] = None
 
 
 @router.get("", response_model=list[model.Currency])
 async def search_currencies(
-    req: Request, params: Annotated[CurrencyParams, Depends(CurrencyParams)]
+    req: Request,
+    params: Annotated[CurrencyParams, Depends(CurrencyParams)],
 ):
     """
-    Search for and list currencies.
+    Search for and list currencies. When ordered by code, the Link header has the
+    cursor links (`_after` / `_before`) to the next and previous pages.
     """
-    async with req.app.pool.connection() as conn:
+    async with read_connection(req) as conn:
         results = await queries.select_currencies(conn, req.app.sql, params)
 
-    return results
+    response = JSONResponse(content=results)
+    if link := params.cursor_links(req.url, results):
+        response.headers["Link"] = link
+    return response
 
 
 @router.post("", response_model=model.Currency)
@@ -1,10 +1,14 @@
+from http import HTTPStatus
 from typing import Annotated, Optional
 
-from fastapi import APIRouter, Depends, Request
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
 from pydantic import Field
+from sqly import Q
 
 from blackledger import model, types
 from blackledger.db import queries
+from blackledger.db.pool import read_connection
+from blackledger.response import JSONResponse, export_response
 
 from ..search import SearchParams
 
@@ -19,15 +23,20 @@ class LedgerParams(SearchParams):
 
 @router.get("", response_model=list[model.Ledger])
 async def search_ledgers(
-    req: Request, params: Annotated[LedgerParams, Depends(LedgerParams)]
+    req: Request,
+    params: Annotated[LedgerParams, Depends(LedgerParams)],
 ):
     """
-    Search for and list ledgers.
+    Search for and list ledgers. When ordered by id, the Link header has the cursor
+    links (`_after` / `_before`) to the next and previous pages.
     """
-    async with req.app.pool.connection() as conn:
+    async with read_connection(req) as conn:
         results = await queries.select_ledgers(conn, req.app.sql, params)
 
-    return results
+    response = JSONResponse(content=results)
+    if link := params.cursor_links(req.url, results):
+        response.headers["Link"] = link
+    return response
 
 
 @router.post("", response_model=model.Ledger)
@@ -41,3 +50,39 @@ async def save_ledger(req: Request, item: model.Ledger):
     async with req.app.pool.connection() as conn:
         result = await sql.select_one(conn, query, data, Constructor=model.Ledger)
     return result
+
+
+@router.get("/{ledger_id}/export")
+async def export_ledger(
+    req: Request,
+    ledger_id: model.BigIDField,
+    format: Annotated[types.ExportFormat, Query(alias="_format")] = (
+        types.ExportFormat.NDJSON
+    ),
+):
+    """
+    Export all the transactions in the ledger, with their entries, in transaction
+    order. The export is streamed as it is read from the database, so there is no limit
+    on its size.
+    """
+    sql = req.app.sql
+    async with read_connection(req) as conn:
+        ledger = await sql.select_one(
+            conn,
+            sql.queries.SELECT("ledger", filters=[Q.filter("id")]),
+            {"id": ledger_id},
+        )
+    if ledger is None:
+        raise HTTPException(
+            status_code=HTTPStatus.NOT_FOUND,
+            detail=f"Ledger not found: {ledger_id}",
+        )
+
+    async def transactions():
+        async with read_connection(req) as conn:
+            async for tx in queries.stream_transactions(
+                conn, sql, ["e.ledger_id = :ledger_id"], {"ledger_id": ledger_id}
+            ):
+                yield tx
+
+    return export_response(transactions(), format, f"ledger-{ledger_id}")
@@ -1,7 +1,8 @@
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, Request
 
 from blackledger.auth import JWTAuthorization
 from blackledger.meta import __name__, __version__
+from blackledger.metrics import COUNTERS
 from blackledger.settings import AuthSettings
 
 from . import accounts, currencies, ledgers, transactions
@@ -24,3 +25,25 @@ async def home():
         "name": __name__,
         "version": __version__,
     }
+
+
+@router.get("/stats", tags=["home"])
+async def stats(req: Request):
+    """
+    Display the statistics of this worker process: its database connection pools (size,
+    available connections, waiting requests, and the counts and total wait time of
+    connection requests -- see psycopg_pool `get_stats()`), the number of transactions
+    in its posting queue (if enabled), and its metrics counters.
+    """
+    return {
+        "pool": req.app.pool.get_stats(),
+        "read_pool": (
+            req.app.read_pool.get_stats()
+            if req.app.read_pool is not req.app.pool
+            else None
+        ),
+        "posting_queue": (
+            req.app.posting_queue.queue.qsize() if req.app.posting_queue else None
+        ),
+        "counters": dict(COUNTERS),
+    }
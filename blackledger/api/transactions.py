@@ -1,12 +1,19 @@
+from datetime import datetime
+from decimal import Decimal
 from http import HTTPStatus
 from typing import Annotated, Optional
 
-from fastapi import APIRouter, Depends, HTTPException, Request
-from pydantic import Field
-from sqly import Q
+import orjson
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Request, Response
+from psycopg.errors import UniqueViolation
+from pydantic import Field, PrivateAttr, ValidationError
 
-from blackledger import model, types
+from blackledger import imports, model, posting, types
 from blackledger.db import queries
+from blackledger.db.pool import LSN_HEADER, read_connection, write_lsn
+from blackledger.db.retry import UNAVAILABLE_ERRORS, retry_transaction
+from blackledger.metrics import TRANSACTION_ENTRIES, TRANSACTION_RESULTS
+from blackledger.response import JSONResponse
 
 from ..search import SearchParams
 
@@ -21,112 +28,463 @@ class TransactionParams(SearchParams):
     )
     acct: Optional[model.BigIDSearchField] = Field(default=None)
     curr: Optional[types.CurrencyCode] = Field(default=None)
+    # entry amount (dr or cr) range, inclusive
+    min_amount: Optional[Decimal] = Field(default=None)
+    max_amount: Optional[Decimal] = Field(default=None)
     # transaction fields
     memo: Optional[str] = Field(default=None)
+    # date ranges: from (inclusive) - to (exclusive)
+    effective_from: Optional[datetime] = Field(default=None)
+    effective_to: Optional[datetime] = Field(default=None)
+    posted_from: Optional[datetime] = Field(default=None)
+    posted_to: Optional[datetime] = Field(default=None)
+    # the `meta` containment filter, from the `meta.KEY=VALUE` query params
+    _meta: dict = PrivateAttr(default_factory=dict)
+
+    def set_meta(self, query_params):
+        """
+        Set the `meta` containment filter from the `meta.KEY=VALUE` query params: The
+        transactions match if their meta contains all the given values. Dotted keys
+        (`meta.customer.id=...`) are nested objects. Values are parsed as JSON if they
+        can be (numbers, true/false, quoted strings), otherwise they are strings.
+
+        The params are merged like jsonb `||` at each level of nesting: A param's value
+        replaces the value of the same key in the earlier params, and the objects of
+        nested keys are merged. A key can't be both a value and an object of nested
+        keys, whichever of the params comes first.
+        """
+        for key, value in query_params.multi_items():
+            if not key.startswith("meta."):
+                continue
+            names = key.split(".")[1:]
+            if not all(names):
+                raise ValueError(f"Invalid meta filter: {key}")
+            try:
+                value = orjson.loads(value)
+            except orjson.JSONDecodeError:
+                pass
+            for name in reversed(names):
+                value = {name: value}
+            self._meta = _merge_meta(self._meta, value, key)
+
+    def filter_data(self):
+        data = super().filter_data()
+        if self._meta:
+            data["meta"] = orjson.dumps(self._meta).decode()
+        return data
 
     def select_filters(self):
         """
-        Specify transaction query filters by table to resolve ambiguity.
+        Specify transaction query filters by table to resolve ambiguity. The entry
+        filters are applied in an EXISTS semi-join, so that each transaction is selected
+        once without joining and de-duplicating all of its entries, and the query can be
+        ordered and limited on the transaction table. The semi-join is on the partition
+        key (ledger_id) as well, and a ledger filter prunes both tables to its partition.
         """
         data = self.query_data()
-        entry_bigid_search = ["tx", "ledger_id", "acct"]
-        entry_str = ["curr"]
+        transaction_bigid_search = {"tx": "id", "ledger_id": "ledger_id"}
+        # (memo regex filters can use the trigram index on memo, and meta containment
+        # filters the GIN index on meta -- see the transaction_search migration)
         transaction_str = ["memo"]
-        return (
+        # (the ranges are sargable on the (ledger_id, effective, id) and (ledger_id,
+        # posted, id) indexes, and the amounts on the entry (acct, amount) index -- see
+        # the search_ranges migration)
+        transaction_range = {
+            "effective_from": "effective >=",
+            "effective_to": "effective <",
+            "posted_from": "posted >=",
+            "posted_to": "posted <",
+        }
+        entry_bigid_search = ["acct"]
+        entry_str = ["curr"]
+        entry_range = {"min_amount": ">=", "max_amount": "<="}
+        entry_filters = (
             [
                 f"entry.{field} = ANY(:{field})"
                 for field in entry_bigid_search
                 if field in data
             ]
             + [f"entry.{field} ~* :{field}" for field in entry_str if field in data]
+            + [
+                f"COALESCE(entry.dr, entry.cr) {op} :{field}"
+                for field, op in entry_range.items()
+                if field in data
+            ]
+        )
+        return (
+            [
+                f"transaction.{column} = ANY(:{field})"
+                for field, column in transaction_bigid_search.items()
+                if field in data
+            ]
             + [
                 f"transaction.{field} ~* :{field}"
                 for field in transaction_str
                 if field in data
             ]
+            + [
+                f"transaction.{column_op} :{field}"
+                for field, column_op in transaction_range.items()
+                if field in data
+            ]
+            + (["transaction.meta @> CAST(:meta AS jsonb)"] if "meta" in data else [])
+            + self.cursor_filters("transaction.id")
+            + [
+                "EXISTS (SELECT 1 FROM entry WHERE "
+                + " AND ".join(
+                    [
+                        "entry.ledger_id = transaction.ledger_id",
+                        "entry.tx = transaction.id",
+                    ]
+                    + entry_filters
+                )
+                + ")"
+            ]
         )
 
 
+def _merge_meta(meta: dict, new: dict, key: str) -> dict:
+    """
+    Merge the new `meta` filter object into the existing one (see
+    TransactionParams.set_meta), raising ValueError for the given param key if a key
+    would be both a value and an object of nested keys.
+    """
+    merged = dict(meta)
+    for name, value in new.items():
+        existing = merged.get(name)
+        if isinstance(existing, dict) and isinstance(value, dict):
+            merged[name] = _merge_meta(existing, value, key)
+        elif name in merged and (isinstance(existing, dict) or isinstance(value, dict)):
+            raise ValueError(f"Invalid meta filter: {key}")
+        else:
+            merged[name] = value
+    return merged
+
+
+def transaction_params(
+    req: Request, params: Annotated[TransactionParams, Depends(TransactionParams)]
+) -> TransactionParams:
+    """
+    The TransactionParams of the request, with the `meta.KEY=VALUE` query params (which
+    are not fields, because the keys are arbitrary).
+    """
+    try:
+        params.set_meta(req.query_params)
+    except ValueError as exc:
+        raise HTTPException(
+            status_code=HTTPStatus.UNPROCESSABLE_ENTITY, detail=str(exc)
+        )
+    return params
+
+
 @router.get("", response_model=list[model.Transaction])
 async def search_transactions(
-    req: Request, params: Annotated[TransactionParams, Depends(TransactionParams)]
+    req: Request,
+    params: Annotated[TransactionParams, Depends(transaction_params)],
 ):
     """
-    Search for and list transactions.
+    Search for and list transactions. When ordered by id, the Link header has the
+    cursor links (`_after` / `_before`) to the next and previous pages.
+
+    The `effective_from` / `effective_to` and `posted_from` / `posted_to` params select
+    the transactions in a date range (from is inclusive, to is exclusive), and the
+    `min_amount` / `max_amount` params the transactions with an entry in an amount range
+    (inclusive, along with the other entry filters: `acct`, `curr`).
+
+    Transactions can be filtered by their `meta` with `meta.KEY=VALUE` query params
+    (such as `meta.invoice_id=INV-1001`): The transactions whose meta contains all the
+    given values are listed.
     """
-    async with req.app.pool.connection() as conn:
+    async with read_connection(req) as conn:
         results = await queries.select_transactions(conn, req.app.sql, params)
 
-    return results
+    response = JSONResponse(content=results)
+    if link := params.cursor_links(req.url, results):
+        response.headers["Link"] = link
+    return response
 
 
 @router.post("", status_code=HTTPStatus.CREATED, response_model=model.Transaction)
-async def post_transaction(req: Request, item: model.NewTransaction):
+async def post_transaction(
+    req: Request,
+    response: Response,
+    item: model.NewTransaction,
+    idempotency_key: Annotated[Optional[types.IdempotencyKey], Header()] = None,
+):
     """
     Post a transaction. (Once a transaction has been posted, BlackLedger provides no
     means to alter it: Transaction and Entry records are immutable in the database. To
     change a transaction, issue a new transaction that adjusts or reverses it.)
+
+    If the transaction has an idempotency key (the Idempotency-Key header or the
+    `idempotency_key` field), and a transaction with that key has already been posted to
+    the ledger, the original transaction is returned (200 OK, with the header
+    Idempotent-Replayed: true) instead of posting it again.
+
+    If there is a read replica, the Ledger-LSN header of the response can be passed as
+    the Read-After-LSN header of later requests, so that they read this transaction.
+
+    With the posting queue (DATABASE_POSTING_QUEUE), the transaction is committed along
+    with other requests' transactions (group commit), with the same results.
     """
+    if idempotency_key:
+        item.idempotency_key = idempotency_key
+
     # the input item has been validated -- just post it
     sql = req.app.sql
-    async with req.app.pool.connection() as conn:  # (creates a db tx context)
-        # create the transaction
-        tx_data = item.model_dump(exclude=["entries"], exclude_none=True)
-        tx = await sql.select_one(
-            conn,
-            sql.queries.INSERT("transaction", tx_data, returning=True),
-            tx_data,
+
+    async def post():
+        async with req.app.pool.connection() as conn:  # (creates a db tx context)
+            tx, replayed = await post_item(conn)
+            # (the LSN is read on this connection, once the transaction is committed)
+            await conn.commit()
+            return tx, replayed, await write_lsn(req, conn)
+
+    async def post_item(conn):
+        if item.idempotency_key and (tx := await _select_replayed(conn, sql, item)):
+            return tx, True
+
+        accts_versions = await queries.select_account_versions(
+            conn, sql, [entry_item.acct for entry_item in item.entries]
+        )
+        posting.check_accounts_versions(item, accts_versions)
+        try:
+            return await queries.insert_transaction(conn, sql, item), False
+        except UniqueViolation:
+            # a concurrent request with the same idempotency key posted it first
+            await conn.rollback()
+            if item.idempotency_key and (tx := await _select_replayed(conn, sql, item)):
+                return tx, True
+            raise
+
+    if req.app.posting_queue:
+        tx, replayed, lsn = await _post_queued(req, item)
+    else:
+        tx, replayed, lsn = await retry_transaction(
+            post, "post_transaction", attempts=req.app.settings.db.retry_attempts
         )
+    if replayed:
+        response.status_code = HTTPStatus.OK
+        response.headers["Idempotent-Replayed"] = "true"
+    else:
+        TRANSACTION_ENTRIES.observe(len(item.entries))
+    if lsn:
+        response.headers[LSN_HEADER] = lsn
 
-        # create each entry
-        entries = []
-        entry_accts_versions = {}
-        for entry_item in item.entries:
-            acct = await sql.select_one(
-                conn,
-                sql.queries.SELECT(
-                    "account", fields=["version"], filters=[Q.filter("id")]
-                ),
-                {"id": entry_item.acct},
+    return tx
+
+
+async def _post_queued(req: Request, item: model.NewTransaction):
+    """
+    Post the transaction through the posting queue (group commit), and return it,
+    whether it was replayed, and the LSN of its group's commit (if there is a read
+    replica), or raise the error that prevented it from being posted.
+    """
+    result = await req.app.posting_queue.post(item)
+    if result.status not in [HTTPStatus.CREATED, HTTPStatus.OK]:
+        raise HTTPException(status_code=result.status, detail=result.detail)
+    tx = result.transaction
+    if tx is None:
+        # an idempotent replay of a transaction that was posted earlier
+        async with req.app.pool.connection() as conn:
+            tx = await _select_replayed(conn, req.app.sql, item)
+    return tx, result.status == HTTPStatus.OK, result.lsn
+
+
+async def _select_replayed(conn, sql, item: model.NewTransaction):
+    return await queries.select_transaction_by_key(
+        conn, sql, item.ledger_id, item.idempotency_key
+    )
+
+
+@router.post("/batch", response_model=list[model.TransactionResult])
+async def post_transactions_batch(
+    req: Request,
+    response: Response,
+    chunk: Annotated[Optional[int], Query(alias="_chunk", gt=0)] = None,
+):
+    """
+    Post a batch of transactions. The request body is either a JSON array of
+    transactions or (with Content-Type: application/x-ndjson) one transaction per line.
+    Each transaction is validated and posted independently, and the response lists the
+    result for each transaction in the order given: its status and id, or the error
+    that prevented it from being posted.
+
+    By default the batch is written in a single database transaction; with `_chunk=N`,
+    each chunk of N transactions is committed separately. Within a chunk, the
+    transactions and their entries are written with a constant number of queries.
+
+    Transactions with an `idempotency_key` that has already been posted to the ledger
+    (or that repeats a key earlier in the batch) are not posted again: Their result is
+    200 OK with the id of the original transaction.
+
+    Entry versions are checked against the accounts as they stand after the earlier
+    transactions in the batch, so a version given for an account that an earlier
+    transaction in the batch posted to is out of date (412).
+
+    If a chunk can't be committed because the database is unavailable (after retrying
+    it as configured), the results of its transactions and of those in the later
+    chunks, which are not posted, are 503 Service Unavailable; the earlier chunks stay
+    committed.
+    """
+    data = await _read_batch(req)
+    results = [None] * len(data)
+
+    items = []
+    for index, item_data in enumerate(data):
+        try:
+            items.append((index, model.NewTransaction.model_validate(item_data)))
+        except ValidationError as exc:
+            results[index] = model.TransactionResult(
+                index=index,
+                status=HTTPStatus.UNPROCESSABLE_ENTITY,
+                detail=exc.errors(include_url=False, include_context=False),
             )
-            if acct is None:
-                raise HTTPException(
-                    status_code=HTTPStatus.NOT_FOUND,
-                    detail=f"Account not found: {entry_item.acct}",
+
+    sql = req.app.sql
+    chunk = chunk or len(items) or 1  # default: the whole batch in one db transaction
+    try:
+        async with req.app.pool.connection() as conn:
+            for start in range(0, len(items), chunk):
+                chunk_items = items[start : start + chunk]
+                for result in await retry_transaction(
+                    lambda: posting.post_transactions_chunk(conn, sql, chunk_items),
+                    "post_transactions_batch",
+                    attempts=req.app.settings.db.retry_attempts,
+                ):
+                    results[result.index] = result
+            if lsn := await write_lsn(req, conn):
+                response.headers[LSN_HEADER] = lsn
+    except UNAVAILABLE_ERRORS as exc:
+        # the transactions in this chunk and the later ones have not been posted
+        for index, _ in items:
+            if results[index] is None:
+                results[index] = model.TransactionResult(
+                    index=index, status=HTTPStatus.SERVICE_UNAVAILABLE, detail=str(exc)
                 )
 
-            # if we've updated the version in this transaction, use it (we know the
-            # earlier account version was correct because it has been updated.)
-            if entry_item.acct in entry_accts_versions:
-                entry_item.version = entry_accts_versions[entry_item.acct]
-
-            # ensure that each entry's account.version, if given, is equal to the latest
-            # entry for that account (OPTIONAL optimistic locking / concurrency control)
-            if entry_item.version and acct["version"] != entry_item.version:
-                raise HTTPException(
-                    status_code=HTTPStatus.PRECONDITION_FAILED,
-                    detail="Entry account_version is out of date",
+    entries = {index: len(item.entries) for index, item in items}
+    for result in results:
+        TRANSACTION_RESULTS.labels(status=result.status).inc()
+        if result.status == HTTPStatus.CREATED:
+            TRANSACTION_ENTRIES.observe(entries[result.index])
+
+    return results
+
+
+async def _read_batch(req: Request) -> list:
+    """
+    Read the request body as a list of transaction data: Either a JSON array or NDJSON.
+    """
+    body = await req.body()
+    try:
+        if req.headers.get("content-type", "").startswith("application/x-ndjson"):
+            data = [orjson.loads(line) for line in body.splitlines() if line.strip()]
+        else:
+            data = orjson.loads(body)
+    except orjson.JSONDecodeError as exc:
+        raise HTTPException(
+            status_code=HTTPStatus.UNPROCESSABLE_ENTITY,
+            detail=f"Invalid JSON: {exc}",
+        )
+    if not isinstance(data, list):
+        raise HTTPException(
+            status_code=HTTPStatus.UNPROCESSABLE_ENTITY,
+            detail="The request body must be a list of transactions",
+        )
+    return data
+
+
+@router.post("/import", response_model=model.ImportResult)
+async def import_transactions(req: Request, response: Response):
+    """
+    Import a large number of transactions from a streamed request body: Either NDJSON,
+    one transaction per line, or (with Content-Type: text/csv) CSV, one row per entry,
+    in the format of the ledger and account exports (see imports.read_csv).
+
+    The body is read and validated as it arrives and copied into the database (see
+    queries.import_transactions), so that the whole import is never held in memory. The
+    import is written in a single database transaction, with the same results as a
+    batch: The response has the number of transactions imported, and the result of each
+    transaction that wasn't, by its index in the body. Entry versions are not supported.
+
+    A body that can't be read (invalid UTF-8, or CSV rows without a `tx`) fails the
+    whole import (422), as does a line (or CSV record) longer than 1 MiB.
+
+    The import holds one database connection while the body is uploaded, and it is not
+    retried on a serialization failure (the body can only be read once).
+    """
+    if req.headers.get("content-type", "").startswith("text/csv"):
+        data = imports.read_csv(req.stream())
+    else:
+        data = imports.read_ndjson(req.stream())
+
+    invalid, entries = [], {}
+
+    async def valid_items():
+        index = 0
+        async for item_data in data:
+            try:
+                if isinstance(item_data, str):
+                    item = model.NewTransaction.model_validate_json(item_data)
+                else:
+                    item = model.NewTransaction.model_validate(item_data)
+                _check_import(item)
+            except ValidationError as exc:
+                invalid.append(
+                    model.TransactionResult(
+                        index=index,
+                        status=HTTPStatus.UNPROCESSABLE_ENTITY,
+                        detail=exc.errors(include_url=False, include_context=False),
+                    )
                 )
+            except HTTPException as exc:
+                invalid.append(
+                    model.TransactionResult(
+                        index=index, status=exc.status_code, detail=exc.detail
+                    )
+                )
+            else:
+                entries[index] = len(item.entries)
+                yield index, item
+            index += 1
 
-            entry_item.tx = tx["id"]
-            entry_data = entry_item.model_dump(exclude=["version"], exclude_none=True)
-            entry = await sql.select_one(
-                conn,
-                sql.queries.INSERT("entry", entry_data, returning=True),
-                entry_data,
-                Constructor=model.Entry,
-            )
-            entries.append(entry)
-
-            # update the associated account - account.version is the entry.id
-            await sql.execute(
-                conn,
-                sql.queries.UPDATE(
-                    "account", fields=["version"], filters=[Q.filter("id")]
-                ),
-                {"id": entry.acct, "version": entry.id},
+    async with req.app.pool.connection() as conn:
+        try:
+            async with conn.transaction():
+                imported, results = await queries.import_transactions(
+                    conn, req.app.sql, valid_items()
+                )
+        except imports.ImportFormatError as exc:
+            raise HTTPException(
+                status_code=HTTPStatus.UNPROCESSABLE_ENTITY, detail=str(exc)
             )
-            # update the local cache for use later in the transaction
-            entry_accts_versions[entry.acct] = entry.id
+        if lsn := await write_lsn(req, conn):
+            response.headers[LSN_HEADER] = lsn
+
+    results = sorted(invalid + results, key=lambda result: result.index)
+    not_imported = {result.index for result in results}
+    for index, count in entries.items():
+        if index not in not_imported:
+            TRANSACTION_ENTRIES.observe(count)
+    TRANSACTION_RESULTS.labels(status=HTTPStatus.CREATED).inc(imported)
+    for result in results:
+        TRANSACTION_RESULTS.labels(status=result.status).inc()
+
+    return model.ImportResult(imported=imported, results=results)
 
-    return model.Transaction(entries=entries, **tx)
+
+def _check_import(item: model.NewTransaction):
+    """
+    Ensure that the (validated) transaction can be imported.
+    """
+    if not item.entries:
+        raise HTTPException(
+            status_code=HTTPStatus.UNPROCESSABLE_ENTITY,
+            detail="An imported transaction must have entries",
+        )
+    if any(entry.version for entry in item.entries):
+        raise HTTPException(
+            status_code=HTTPStatus.UNPROCESSABLE_ENTITY,
+            detail="Entry account_version is not supported for imports",
+        )
@@ -1,7 +1,13 @@
+import asyncio
+import hashlib
 import logging
 import re
+import threading
+import time
 import traceback
+from collections import OrderedDict
 from http import HTTPStatus
+from typing import Optional
 
 import jwt
 from fastapi import HTTPException
@@ -11,10 +17,114 @@ from starlette.requests import Request
 LOG = logging.getLogger(__name__)
 
 
+class TokenCache:
+    """
+    A bounded LRU cache of the claims of verified tokens, keyed by the hash of the
+    token. Claims are only returned until the token expires.
+    """
+
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self.claims = OrderedDict()
+
+    @staticmethod
+    def key(token: str) -> bytes:
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, token: str) -> Optional[dict]:
+        key = self.key(token)
+        claims = self.claims.get(key)
+        if claims is None:
+            return None
+        if claims["exp"] <= time.time():
+            del self.claims[key]
+            return None
+        self.claims.move_to_end(key)
+        return claims
+
+    def set(self, token: str, claims: dict):
+        # tokens without an expiration are never cached.
+        if self.maxsize <= 0 or not isinstance(claims.get("exp"), (int, float)):
+            return
+        key = self.key(token)
+        self.claims[key] = claims
+        self.claims.move_to_end(key)
+        while len(self.claims) > self.maxsize:
+            self.claims.popitem(last=False)
+
+
+class SigningKeyCache:
+    """
+    A cache of the signing keys of the JWKS, by key id (kid). The keys are only trusted
+    for `lifespan` seconds after they were fetched, so that a key that is rotated out of
+    the JWKS (or revoked) is no longer trusted after that. If fetching them again fails,
+    the stale keys are used until a fetch succeeds.
+
+    A token with an unknown kid fetches the keys again (the key might be new), but the
+    keys are fetched at most once every `refresh_interval` seconds, so that tokens with
+    made-up kids can't make every request fetch the JWKS. Only one fetch is made at a
+    time: Other threads wait for it, or use the stale keys.
+    """
+
+    def __init__(
+        self, client: jwt.PyJWKClient, lifespan: float, refresh_interval: float
+    ):
+        self.client = client
+        self.lifespan = lifespan
+        self.refresh_interval = refresh_interval
+        self.keys = {}
+        self.fetched = self.attempted = float("-inf")  # (time.monotonic)
+        self.lock = threading.Lock()
+
+    def get_signing_key_from_jwt(self, token: str) -> jwt.PyJWK:
+        return self.get_signing_key(jwt.get_unverified_header(token).get("kid"))
+
+    def get_signing_key(self, kid: str) -> jwt.PyJWK:
+        if time.monotonic() - self.fetched >= self.lifespan:
+            self.refresh(wait=not self.keys)
+        key = self.keys.get(kid)
+        if key is None:
+            self.refresh()
+            key = self.keys.get(kid)
+        if key is None:
+            raise jwt.PyJWKClientError(
+                f'Unable to find a signing key that matches: "{kid}"'
+            )
+        return key
+
+    def refresh(self, wait: bool = True):
+        """
+        Fetch the keys, unless a fetch has been attempted in the last refresh_interval
+        seconds. If another thread is fetching them, wait for it (unless not `wait`).
+        """
+        if not self.lock.acquire(blocking=wait):
+            return
+        try:
+            if time.monotonic() - self.attempted < self.refresh_interval:
+                return
+            self.attempted = time.monotonic()
+            try:
+                keys = self.client.get_signing_keys(refresh=True)
+            except Exception:
+                if not self.keys:
+                    raise
+                LOG.warning(f"Using stale JWKS keys: {traceback.format_exc()}")
+                return
+            self.keys = {key.key_id: key for key in keys}
+            self.fetched = self.attempted
+        finally:
+            self.lock.release()
+
+
 class JWTAuthorization(APIKeyHeader):
     """
     Middleware that protects every request in the router by ensuring that the request
     client has a valid (signed) token (JWT) in the Authorization header.
+
+    Verified tokens are cached until they expire, so that repeated requests with the
+    same token are not verified again. Signing keys are cached by kid for the JWKS
+    lifespan (see SigningKeyCache); fetching and verifying run in a worker thread, so
+    as not to block the event loop.
     """
 
     TOKEN_PATTERN = re.compile(r"^.*Bearer\s*(.*)$", flags=re.I)
@@ -22,7 +132,16 @@ class JWTAuthorization(APIKeyHeader):
     def __init__(self, auth_settings, **kwargs):
         super().__init__(**kwargs)
         self.settings = auth_settings
-        self.client = jwt.PyJWKClient(self.settings.jwks_url)
+        self.signing_keys = SigningKeyCache(
+            jwt.PyJWKClient(
+                self.settings.jwks_url,
+                cache_jwk_set=False,
+                timeout=self.settings.jwks_timeout,
+            ),
+            lifespan=self.settings.jwks_lifespan,
+            refresh_interval=self.settings.jwks_refresh_interval,
+        )
+        self.tokens = TokenCache(maxsize=self.settings.token_cache_size)
 
     async def __call__(self, request: Request):
         if request.app.settings.auth.disabled is True:
@@ -30,7 +149,7 @@ class JWTAuthorization(APIKeyHeader):
         try:
             bearer = request.headers.get("Authorization")
             assert bearer is not None, "Authorization header not found"
-            request.state.auth_claims = self.decode(bearer)
+            request.state.auth_claims = await self.authorize(bearer)
         except Exception as exc:
             LOG.warning(traceback.format_exc())
             raise HTTPException(
@@ -38,6 +157,18 @@ class JWTAuthorization(APIKeyHeader):
                 detail=f"Unauthorized: {exc.__class__.__name__}: {str(exc)}",
             )
 
+    async def authorize(self, bearer) -> dict:
+        """
+        Return the claims of the (identity) token in the given Authorization header
+        value, from the cache if it has already been verified and hasn't expired.
+        Otherwise, decode it in a worker thread (see decode).
+        """
+        claims = self.tokens.get(bearer)
+        if claims is None:
+            claims = await asyncio.to_thread(self.decode, bearer)
+            self.tokens.set(bearer, claims)
+        return claims
+
     def decode(self, bearer) -> dict:
         """
         If the signature and required claims of the (identity) token are valid, decode
@@ -46,7 +177,7 @@ class JWTAuthorization(APIKeyHeader):
         is not yet valid, or it has expired.
         """
         token = re.sub(self.TOKEN_PATTERN, r"\1", bearer)
-        key = self.client.get_signing_key_from_jwt(token).key
+        key = self.signing_keys.get_signing_key_from_jwt(token).key
         claims = jwt.decode(
             token,
             key,
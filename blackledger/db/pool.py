@@ -0,0 +1,119 @@
+import asyncio
+import logging
+import re
+import time
+from contextlib import asynccontextmanager
+from http import HTTPStatus
+from typing import Optional
+
+import psycopg_pool
+from fastapi import HTTPException
+from starlette.requests import Request
+
+from blackledger.metrics import COUNTERS
+from blackledger.settings import DatabaseSettings
+
+LOG = logging.getLogger(__name__)
+
+# The request header with the (WAL) LSN of a write that a read must see -- the value of
+# the LSN_HEADER in the response to the write.
+READ_AFTER_LSN_HEADER = "Read-After-LSN"
+LSN_HEADER = "Ledger-LSN"
+LSN_PATTERN = re.compile(r"^[0-9A-Fa-f]{1,8}/[0-9A-Fa-f]{1,8}$")
+
+
+def create_pool(settings: DatabaseSettings, conninfo: str, name: str):
+    """
+    Create a connection pool (not yet open) with the given database settings.
+    """
+    return psycopg_pool.AsyncConnectionPool(
+        conninfo=conninfo,
+        # prepare_threshold=None disables prepared statements (see db.queries)
+        kwargs={} if settings.prepare else {"prepare_threshold": None},
+        min_size=settings.pool_min_size,
+        max_size=settings.pool_max_size,
+        timeout=settings.pool_timeout,
+        max_waiting=settings.pool_max_waiting,
+        max_idle=settings.pool_max_idle,
+        max_lifetime=settings.pool_max_lifetime,
+        check=(
+            psycopg_pool.AsyncConnectionPool.check_connection
+            if settings.pool_check
+            else None
+        ),
+        name=name,
+        open=False,
+    )
+
+
+@asynccontextmanager
+async def read_connection(req: Request):
+    """
+    A database connection for a read-only request: From the read (replica) pool if
+    there is one, otherwise from the primary pool.
+
+    Read-your-writes: If the request has a Read-After-LSN header (the Ledger-LSN of a
+    previous write), wait (up to DATABASE_READ_LSN_TIMEOUT seconds) for the replica to
+    replay that LSN, and if it hasn't, read from the primary instead.
+    """
+    app = req.app
+    if app.read_pool is app.pool:
+        async with app.pool.connection() as conn:
+            yield conn
+        return
+
+    lsn = req.headers.get(READ_AFTER_LSN_HEADER)
+    if lsn is not None and not LSN_PATTERN.match(lsn):
+        raise HTTPException(
+            status_code=HTTPStatus.UNPROCESSABLE_ENTITY,
+            detail=f"Invalid {READ_AFTER_LSN_HEADER}: {lsn}",
+        )
+
+    async with app.read_pool.connection() as conn:
+        if lsn is None or await _wait_for_replay(
+            conn, app.sql, lsn, app.settings.db.read_lsn_timeout
+        ):
+            yield conn
+            return
+
+    COUNTERS["read_pool.lsn_fallback"] += 1
+    async with app.pool.connection() as conn:
+        yield conn
+
+
+async def _wait_for_replay(conn, sql, lsn: str, timeout: float) -> bool:
+    """
+    Wait until the replica has replayed the given LSN, up to the timeout (seconds).
+    Return whether it has.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        result = await sql.select_one(
+            conn,
+            "SELECT pg_last_wal_replay_lsn() >= CAST(:lsn AS pg_lsn) AS replayed",
+            {"lsn": lsn},
+        )
+        # (replay_lsn is null if the database isn't a replica)
+        if result["replayed"] is not False or time.monotonic() >= deadline:
+            return result["replayed"] is not False
+        await asyncio.sleep(0.01)
+
+
+async def write_lsn(req: Request, conn) -> Optional[str]:
+    """
+    If there is a read (replica) pool, return the current LSN of the primary's WAL,
+    which a read connection must replay to see the writes that have been committed.
+    Read it on the connection that committed the writes, after the commit: Checking out
+    another connection could fail after the writes have been committed.
+    """
+    if req.app.read_pool is req.app.pool:
+        return None
+    return await current_lsn(req.app.sql, conn)
+
+
+async def current_lsn(sql, conn) -> str:
+    """
+    Return the current LSN of the primary's WAL (see `write_lsn()`).
+    """
+    result = await sql.select_one(conn, "SELECT CAST(pg_current_wal_lsn() AS text) lsn")
+    return result["lsn"]
@@ -1,11 +1,86 @@
 import logging
+from collections import OrderedDict
+from datetime import datetime
+from typing import AsyncIterator, Callable, Optional, Union
 
+import orjson
+from psycopg.rows import dict_row
 from sqly import SQL
 
-from blackledger import model, search
+from blackledger import model, search, types
+from blackledger.metrics import timed_query
 
 LOG = logging.getLogger(__name__)
 
+# The maximum number of rendered queries to cache (see render_query).
+QUERY_CACHE_SIZE = 512
+_rendered_queries = OrderedDict()
+
+
+def render_query(sql: SQL, query: Union[str, Callable], data: dict, key=None) -> str:
+    """
+    Render the query for the SQL dialect. The rendered query string is cached by key
+    (default: the query), so that it is only built and rendered once: The query can be a
+    function that builds the query, and dynamic queries (such as searches) are cached by
+    the shape of their params (see SearchParams.query_shape). The data is passed to the
+    database as it is, so its values must be adaptable by the database driver.
+    """
+    cache_key = (sql.dialect, key or query)
+    query_str = _rendered_queries.get(cache_key)
+    if query_str is None:
+        query_str, _ = sql.render(query() if callable(query) else query, data)
+        _rendered_queries[cache_key] = query_str
+        if len(_rendered_queries) > QUERY_CACHE_SIZE:
+            _rendered_queries.popitem(last=False)
+    else:
+        _rendered_queries.move_to_end(cache_key)
+    return query_str
+
+
+def _prepare(conn) -> Optional[bool]:
+    # Prepare the statement right away, unless prepared statements are disabled on the
+    # connection (prepare_threshold=None, such as behind a transaction pooler).
+    return None if conn.prepare_threshold is None else True
+
+
+async def select_prepared(
+    conn,
+    sql: SQL,
+    query: Union[str, Callable],
+    data: dict,
+    key=None,
+    Constructor=dict,
+) -> list:
+    """
+    Execute the (cached, rendered) query as a server-side prepared statement, and return
+    all of its results as Constructor objects (default: dicts). Postgres plans each
+    prepared statement once per connection rather than once per execution. (See
+    render_query for the query and key.)
+
+    The search queries select exactly the fields of their models, so that the API can
+    serialize the result rows as they are, without validating them against the
+    response_model.
+    """
+    async with conn.cursor(row_factory=dict_row) as cursor:
+        await cursor.execute(
+            render_query(sql, query, data, key=key), data, prepare=_prepare(conn)
+        )
+        results = await cursor.fetchall()
+    if Constructor is dict:
+        return results
+    return [Constructor(**result) for result in results]
+
+
+async def execute_prepared(
+    conn, sql: SQL, query: Union[str, Callable], data: dict, key=None
+):
+    """
+    Execute the (cached, rendered) query as a server-side prepared statement.
+    """
+    await conn.execute(
+        render_query(sql, query, data, key=key), data, prepare=_prepare(conn)
+    )
+
 
 def _get_where_clause(params: search.SearchParams) -> list[str]:
     select_filters = params.select_filters()
@@ -27,98 +102,782 @@ def _get_query_params(params: search.SearchParams) -> list[str]:
     return select_args
 
 
-async def select_balances(conn, sql: SQL, params: search.SearchParams):
-    query = [
+@timed_query
+async def select_balances(
+    conn,
+    sql: SQL,
+    params: search.SearchParams,
+    as_of: Optional[datetime] = None,
+    rollup: bool = False,
+):
+    # Current balances are maintained in account_balance as entries are inserted (see
+    # the account_balance migration), so this reads one row per account and currency
+    # (or one per shard, for sharded accounts -- see the account_shards migration),
+    # summed per selected account (LATERAL) so that the lookups use the primary key.
+    # Balances as_of a given effective time are computed per selected account from its
+    # latest balance snapshot at or before that time plus its entries since the snapshot
+    # (see the account_balance_snapshot migration).
+    #
+    # Rolled-up balances are the sums of the balances of each account's subtree, which
+    # are looked up in the account_tree closure table.
+    #
+    # The query is only built once for each shape of the params (see select_prepared).
+    def build():
+        if as_of:
+            source = """account_tree tree
+                CROSS JOIN LATERAL account_balance_as_of(
+                    account.ledger_id, tree.descendant, CAST(:as_of AS timestamptz)
+                ) b"""
+        else:
+            source = (
+                "account_tree tree JOIN account_balance b ON b.acct = tree.descendant"
+            )
+
+        if rollup:
+            balances = f"""LATERAL (
+                SELECT tree.ancestor acct, b.curr, sum(b.dr) dr, sum(b.cr) cr
+                FROM {source}
+                WHERE tree.ancestor = account.id
+                GROUP BY tree.ancestor, b.curr
+            ) balances"""
+        elif as_of:
+            balances = """LATERAL account_balance_as_of(
+                account.ledger_id, account.id, CAST(:as_of AS timestamptz)
+            ) balances"""
+        else:
+            balances = """LATERAL (
+                SELECT b.acct, b.curr, sum(b.dr) dr, sum(b.cr) cr
+                FROM account_balance b
+                WHERE b.acct = account.id
+                GROUP BY b.acct, b.curr
+            ) balances"""
+
+        query = [
+            f"""
+            SELECT account.*,
+                balances.curr, balances.dr, balances.cr
+            FROM account
+            JOIN {balances}
+                ON account.id = balances.acct
+            """
+        ]
+        query.extend(_get_where_clause(params))
+        query.extend(_get_query_params(params))
+        return query
+
+    data = params.query_data()
+    if as_of:
+        data["as_of"] = as_of
+    results = await select_prepared(
+        conn,
+        sql,
+        build,
+        data,
+        key=("select_balances", params.query_shape(), bool(as_of), rollup),
+    )
+
+    return params.order_results(results)
+
+
+@timed_query
+async def select_account_versions(conn, sql: SQL, ids: list[int]) -> dict:
+    """
+    Select the current version and number of balance shards of each of the given
+    accounts in one query, returning a dict of {account id: {"version": version,
+    "shards": shards}}. Accounts that don't exist are not included.
+
+    The (unsharded) accounts are locked for the rest of the database transaction, in id
+    order, so that concurrent postings to the same accounts wait for each other in the
+    same order rather than deadlocking, and the versions can't change before the
+    transaction commits. (FOR NO KEY UPDATE is the lock that updating the version takes,
+    which doesn't block inserting entries for the account.) Sharded accounts are not
+    locked.
+    """
+    query = """
+        WITH locked AS (
+            SELECT id, version, shards FROM account
+            WHERE id = ANY(:ids) AND shards = 0
+            ORDER BY id
+            FOR NO KEY UPDATE
+        )
+        SELECT id, version, shards FROM locked
+        UNION ALL
+        SELECT id, version, shards FROM account
+        WHERE id = ANY(:ids) AND shards > 0
+    """
+    results = await select_prepared(conn, sql, query, {"ids": list(set(ids))})
+    return {result["id"]: result for result in results}
+
+
+async def insert_transaction(conn, sql: SQL, item: model.NewTransaction):
+    """
+    Insert the given transaction and all of its entries, and bump the version of every
+    account touched by the entries. (See `insert_transactions()`.)
+    """
+    return (await insert_transactions(conn, sql, [item]))[0]
+
+
+@timed_query
+async def insert_transactions(conn, sql: SQL, items: list[model.NewTransaction]):
+    """
+    Insert the given transactions and all of their entries, and bump the version of
+    every account touched by the entries. The number of round trips to the database is
+    constant no matter how many transactions and entries there are:
+
+    * one multi-row INSERT ... RETURNING for the transactions,
+    * one multi-row INSERT ... RETURNING for the entries,
+    * one UPDATE ... FROM for the versions of all the entry accounts.
+
+    Rows are passed as array parameters and expanded with unnest(), so that the query
+    text is the same for any number of rows. Rows are inserted (and returned) in the
+    order given.
+
+    The caller is responsible for validating the accounts and their versions first (see
+    `select_account_versions()`) and for the database transaction context.
+    """
+    if not items:
+        return []
+
+    tx_query = """
+        INSERT INTO transaction
+            (id, ledger_id, posted, effective, memo, meta, idempotency_key)
+        SELECT COALESCE(t.id, bigid()), t.ledger_id,
+            COALESCE(t.posted, now()), COALESCE(t.effective, now()),
+            t.memo, CAST(t.meta AS jsonb), t.idempotency_key
+        FROM unnest(
+            CAST(:id AS bigint[]),
+            CAST(:ledger_id AS bigint[]),
+            CAST(:posted AS timestamptz[]),
+            CAST(:effective AS timestamptz[]),
+            CAST(:memo AS text[]),
+            CAST(:meta AS text[]),
+            CAST(:idempotency_key AS varchar[])
+        ) WITH ORDINALITY AS t(
+            id, ledger_id, posted, effective, memo, meta, idempotency_key, n
+        )
+        ORDER BY t.n
+        RETURNING *
+    """
+    tx_data = {
+        "id": [item.id for item in items],
+        "ledger_id": [item.ledger_id for item in items],
+        "posted": [item.posted for item in items],
+        "effective": [item.effective for item in items],
+        "memo": [item.memo for item in items],
+        "meta": [
+            orjson.dumps(item.meta).decode() if item.meta is not None else None
+            for item in items
+        ],
+        "idempotency_key": [item.idempotency_key for item in items],
+    }
+    transactions = await select_prepared(
+        conn, sql, tx_query, tx_data, Constructor=model.Transaction
+    )
+
+    # (entry.effective is the transaction's, given here so that the trigger that would
+    # look it up doesn't have to)
+    entries_query = """
+        INSERT INTO entry (id, ledger_id, tx, effective, acct, curr, dr, cr)
+        SELECT COALESCE(e.id, bigid()), e.ledger_id, e.tx, e.effective, e.acct, e.curr,
+            e.dr, e.cr
+        FROM unnest(
+            CAST(:id AS bigint[]),
+            CAST(:ledger_id AS bigint[]),
+            CAST(:tx AS bigint[]),
+            CAST(:effective AS timestamptz[]),
+            CAST(:acct AS bigint[]),
+            CAST(:curr AS varchar[]),
+            CAST(:dr AS decimal[]),
+            CAST(:cr AS decimal[])
+        ) WITH ORDINALITY AS e(id, ledger_id, tx, effective, acct, curr, dr, cr, n)
+        ORDER BY e.n
+        RETURNING *
+    """
+    new_entries = [
+        (tx, entry_item)
+        for tx, item in zip(transactions, items)
+        for entry_item in item.entries
+    ]
+    entries_data = {
+        "id": [e.id for _, e in new_entries],
+        "ledger_id": [e.ledger_id for _, e in new_entries],
+        "tx": [tx.id for tx, _ in new_entries],
+        "effective": [tx.effective for tx, _ in new_entries],
+        "acct": [e.acct for _, e in new_entries],
+        "curr": [e.curr for _, e in new_entries],
+        "dr": [e.dr for _, e in new_entries],
+        "cr": [e.cr for _, e in new_entries],
+    }
+    entries = await select_prepared(
+        conn, sql, entries_query, entries_data, Constructor=model.Entry
+    )
+
+    # collate entries under their transactions
+    transactions_by_id = {tx.id: tx for tx in transactions}
+    for entry in entries:
+        transactions_by_id[entry.tx].entries.append(entry)
+
+    # account.version is the id of the latest entry for that account. Sharded (hot)
+    # accounts are not versioned, so that postings don't serialize on their row lock.
+    accts_versions = {entry.acct: entry.id for entry in entries}
+    if accts_versions:
+        await execute_prepared(
+            conn,
+            sql,
+            """
+            UPDATE account SET version = v.version
+            FROM unnest(CAST(:acct AS bigint[]), CAST(:version AS bigint[]))
+                AS v(acct, version)
+            WHERE account.id = v.acct
+            AND account.shards = 0
+            """,
+            {
+                "acct": list(accts_versions.keys()),
+                "version": list(accts_versions.values()),
+            },
+        )
+
+    return transactions
+
+
+@timed_query
+async def import_transactions(
+    conn, sql: SQL, items: AsyncIterator[tuple[int, model.NewTransaction]]
+) -> tuple[int, list[model.TransactionResult]]:
+    """
+    Import the (index, NewTransaction) items, which have been validated (and are
+    balanced) but not checked against the database, in the connection's database
+    transaction. Return the number of transactions imported, and a TransactionResult
+    for each item that wasn't, as in a batch: 404 for an account that isn't in the
+    ledger, 409 for an unknown ledger or currency, or 200 with the id of the
+    transaction that was posted earlier with the same idempotency key (in the ledger or
+    earlier in the import).
+
+    The items are written as they are read, with COPY, into a staging table (one row
+    per entry, with its transaction's fields), so that memory use is bounded no matter
+    how many there are. Then the checks, and the move from the staging table to the
+    transaction and entry tables, are a constant number of set-based statements, so the
+    entry triggers (account balances) run once for the whole import.
+
+    The staging tables are temporary (dropped on commit). The import statements are
+    run once per import, so they are not prepared.
+    """
+    await conn.execute(
+        """
+        CREATE TEMPORARY TABLE import_entry (
+            n                   bigint      NOT NULL  -- the index of the transaction
+            , m                 integer     NOT NULL  -- the index of the entry
+            , ledger_id         bigint      NOT NULL
+            , posted            timestamptz
+            , effective         timestamptz
+            , memo              text
+            , meta              jsonb
+            , idempotency_key   varchar
+            , acct              bigint      NOT NULL
+            , curr              varchar     NOT NULL
+            , dr                decimal
+            , cr                decimal
+        ) ON COMMIT DROP
+        """,
+        prepare=False,
+    )
+    async with conn.cursor().copy(
+        """
+        COPY import_entry (n, m, ledger_id, posted, effective, memo, meta,
+            idempotency_key, acct, curr, dr, cr)
+        FROM STDIN
         """
-        WITH balances AS (
-            SELECT a.id account_id,
-                e.curr, sum(e.dr) dr, sum(e.cr) cr
-            FROM account a
-            JOIN entry e
-                ON a.id = e.acct
-            GROUP BY (a.id, e.curr)
+    ) as copy:
+        async for index, item in items:
+            meta = orjson.dumps(item.meta).decode() if item.meta is not None else None
+            for m, entry in enumerate(item.entries):
+                await copy.write_row(
+                    [
+                        index,
+                        m,
+                        item.ledger_id,
+                        item.posted,
+                        item.effective,
+                        item.memo,
+                        meta,
+                        item.idempotency_key,
+                        entry.acct,
+                        entry.curr,
+                        entry.dr,
+                        entry.cr,
+                    ]
+                )
+
+    for query in [
+        # one row per transaction, with its new id and (to be) status
+        """
+        CREATE TEMPORARY TABLE import_transaction ON COMMIT DROP AS
+        SELECT DISTINCT ON (n) n, bigid() id, ledger_id,
+            COALESCE(posted, now()) posted, COALESCE(effective, now()) effective,
+            memo, meta, idempotency_key,
+            CAST(NULL AS integer) status, CAST(NULL AS text) detail,
+            CAST(NULL AS bigint) replayed_id
+        FROM import_entry
+        ORDER BY n
+        """,
+        "CREATE INDEX ON import_entry (n)",
+        "CREATE UNIQUE INDEX ON import_transaction (n)",
+        # (temporary tables are not analyzed automatically)
+        "ANALYZE import_entry, import_transaction",
+        # checks
+        """
+        UPDATE import_transaction t
+        SET status = 409, detail = 'Ledger not found: ' || t.ledger_id
+        WHERE NOT EXISTS (SELECT 1 FROM ledger WHERE ledger.id = t.ledger_id)
+        """,
+        """
+        UPDATE import_transaction t
+        SET status = 404, detail = 'Account not found: ' || e.acct
+        FROM import_entry e
+        WHERE e.n = t.n AND t.status IS NULL
+        AND NOT EXISTS (
+            SELECT 1 FROM account a WHERE a.id = e.acct AND a.ledger_id = e.ledger_id
         )
-        SELECT account.*,
-            balances.curr, balances.dr, balances.cr
-        FROM account
-        JOIN balances
-            ON account.id = balances.account_id
+        """,
         """
-    ]
-    query.extend(_get_where_clause(params))
-    query.extend(_get_query_params(params))
+        UPDATE import_transaction t
+        SET status = 409, detail = 'Currency not found: ' || e.curr
+        FROM import_entry e
+        WHERE e.n = t.n AND t.status IS NULL
+        AND NOT EXISTS (SELECT 1 FROM currency c WHERE c.code = e.curr)
+        """,
+        # idempotency keys: posted earlier to the ledger, or repeated in the import
+        """
+        UPDATE import_transaction t
+        SET status = 200, replayed_id = tx.id
+        FROM transaction tx
+        WHERE t.status IS NULL
+        AND tx.ledger_id = t.ledger_id AND tx.idempotency_key = t.idempotency_key
+        """,
+        """
+        UPDATE import_transaction t
+        SET status = CASE WHEN o.status IS NULL THEN 200 ELSE o.status END,
+            detail = o.detail,
+            replayed_id = CASE WHEN o.status IS NULL THEN o.id ELSE o.replayed_id END
+        FROM (
+            SELECT DISTINCT ON (ledger_id, idempotency_key) *
+            FROM import_transaction
+            WHERE idempotency_key IS NOT NULL
+            ORDER BY ledger_id, idempotency_key, n
+        ) o
+        WHERE t.ledger_id = o.ledger_id
+        AND t.idempotency_key = o.idempotency_key
+        AND t.n > o.n
+        """,
+        # lock the (versioned) accounts in id order, as select_account_versions does
+        """
+        SELECT id FROM account
+        WHERE id IN (
+            SELECT e.acct FROM import_entry e JOIN import_transaction t ON t.n = e.n
+            WHERE t.status IS NULL
+        )
+        AND shards = 0
+        ORDER BY id
+        FOR NO KEY UPDATE
+        """,
+        # move
+        """
+        INSERT INTO transaction
+            (id, ledger_id, posted, effective, memo, meta, idempotency_key)
+        SELECT id, ledger_id, posted, effective, memo, meta, idempotency_key
+        FROM import_transaction
+        WHERE status IS NULL
+        ORDER BY n
+        """,
+        """
+        INSERT INTO entry (ledger_id, tx, effective, acct, curr, dr, cr)
+        SELECT e.ledger_id, t.id, t.effective, e.acct, e.curr, e.dr, e.cr
+        FROM import_entry e
+        JOIN import_transaction t ON t.n = e.n
+        WHERE t.status IS NULL
+        ORDER BY e.n, e.m
+        """,
+        # account.version = the latest entry (as in insert_transactions)
+        """
+        UPDATE account SET version = v.version
+        FROM (
+            SELECT e.acct, max(e.id) version
+            FROM import_transaction t
+            JOIN entry e ON e.ledger_id = t.ledger_id AND e.tx = t.id
+            WHERE t.status IS NULL
+            GROUP BY e.acct
+        ) v
+        WHERE account.id = v.acct
+        AND account.shards = 0
+        """,
+    ]:
+        await conn.execute(query, prepare=False)
 
-    results = await sql.select_all(conn, query, params.query_data())
+    async with conn.cursor(row_factory=dict_row) as cursor:
+        await cursor.execute(
+            """
+            SELECT n, status, detail, replayed_id
+            FROM import_transaction
+            ORDER BY n
+            """,
+            prepare=False,
+        )
+        imported, results = 0, []
+        async for row in cursor:
+            if row["status"] is None:
+                imported += 1
+            else:
+                results.append(
+                    model.TransactionResult(
+                        index=row["n"],
+                        status=row["status"],
+                        id=row["replayed_id"],
+                        detail=row["detail"],
+                    )
+                )
+    return imported, results
 
-    return results
 
+@timed_query
+async def select_transaction_by_key(
+    conn, sql: SQL, ledger_id: int, idempotency_key: str
+) -> Optional[model.Transaction]:
+    """
+    Select the transaction (with its entries) that was posted to the ledger with the
+    given idempotency key, if any.
+    """
+    txs = await select_prepared(
+        conn,
+        sql,
+        """
+        SELECT * FROM transaction
+        WHERE ledger_id = :ledger_id AND idempotency_key = :idempotency_key
+        """,
+        {"ledger_id": ledger_id, "idempotency_key": idempotency_key},
+    )
+    if not txs:
+        return None
 
-async def select_currencies(conn, sql: SQL, params: search.SearchParams):
-    query = sql.queries.SELECT(
-        "currency", filters=params.select_filters(), **params.select_params()
+    tx = txs[0]
+    entries = await select_prepared(
+        conn,
+        sql,
+        "SELECT * FROM entry WHERE ledger_id = :ledger_id AND tx = :tx ORDER BY id",
+        {"ledger_id": ledger_id, "tx": tx["id"]},
+        Constructor=model.Entry,
     )
-    results = await sql.select_all(
+    return model.Transaction(entries=entries, **tx)
+
+
+@timed_query
+async def select_transaction_ids_by_key(conn, sql: SQL, keys: list[tuple]) -> dict:
+    """
+    Select the ids of the transactions with the given (ledger_id, idempotency_key) keys
+    in one query, returning a dict of {key: transaction id}. Keys that haven't been
+    posted are not included.
+    """
+    if not keys:
+        return {}
+    query = """
+        SELECT t.id, t.ledger_id, t.idempotency_key
+        FROM transaction t
+        JOIN unnest(
+            CAST(:ledger_id AS bigint[]),
+            CAST(:idempotency_key AS varchar[])
+        ) AS k(ledger_id, idempotency_key)
+            ON t.ledger_id = k.ledger_id AND t.idempotency_key = k.idempotency_key
+    """
+    results = await select_prepared(
         conn,
+        sql,
         query,
+        {
+            "ledger_id": [ledger_id for ledger_id, _ in keys],
+            "idempotency_key": [idempotency_key for _, idempotency_key in keys],
+        },
+    )
+    return {
+        (result["ledger_id"], result["idempotency_key"]): result["id"]
+        for result in results
+    }
+
+
+@timed_query
+async def select_account(conn, sql: SQL, id: int) -> Optional[dict]:
+    """
+    Select the account with the given id, if it exists.
+    """
+    results = await select_prepared(
+        conn, sql, "SELECT * FROM account WHERE id = :id", {"id": id}
+    )
+    return results[0] if results else None
+
+
+@timed_query
+async def select_register(conn, sql: SQL, account: dict, params) -> list[dict]:
+    """
+    Select a page of the account register (see api.accounts.RegisterParams): The
+    account's entries in effective order, each with its transaction's posted time and
+    memo, and the account's running balance in the entry's currency (signed by the
+    account's normal side).
+
+    The running balance is computed in one pass by a window function over the page,
+    seeded with the opening balance before the page's first entry. The opening balance
+    is the latest balance snapshot before that entry (see script/build_snapshots.py)
+    plus the account's entries since the snapshot, so a page costs about the same no
+    matter how deep in the register it is.
+    """
+
+    def build():
+        filters = ["e.ledger_id = :ledger_id", "e.acct = :acct"]
+        filters += ["e.curr = :curr"] if params.curr else []
+        filters += ["e.effective >= :effective_from"] if params.effective_from else []
+        filters += ["e.effective < :effective_to"] if params.effective_to else []
+        if params.after or params.before:
+            filters.append(
+                f"(e.effective, e.id) {'>' if params.after else '<'}"
+                " (CAST(:cursor_effective AS timestamptz), CAST(:cursor_id AS bigint))"
+            )
+        # _before pages are selected in reverse order
+        direction = " DESC" if params.before else ""
+        return f"""
+            WITH page AS (
+                SELECT e.id, e.tx, e.effective, e.curr, e.dr, e.cr
+                FROM entry e
+                WHERE {" AND ".join(filters)}
+                ORDER BY e.effective{direction}, e.id{direction}
+                LIMIT :_limit
+            ), page_start AS (
+                SELECT effective, id FROM page ORDER BY effective, id LIMIT 1
+            ), snapshot AS (
+                SELECT DISTINCT ON (s.curr) s.curr, s.period, s.dr, s.cr
+                FROM account_balance_snapshot s, page_start
+                WHERE s.acct = :acct AND s.period < page_start.effective
+                ORDER BY s.curr, s.period DESC
+            ), opening AS (
+                SELECT b.curr, sum(b.dr) dr, sum(b.cr) cr
+                FROM (
+                    -- the snapshots and the entries since them
+                    SELECT snapshot.curr, snapshot.dr, snapshot.cr FROM snapshot
+                    UNION ALL
+                    SELECT snapshot.curr, since.dr, since.cr
+                    FROM snapshot, page_start, LATERAL (
+                        SELECT COALESCE(sum(e.dr), 0) dr, COALESCE(sum(e.cr), 0) cr
+                        FROM entry e
+                        WHERE e.ledger_id = :ledger_id AND e.acct = :acct
+                        AND e.curr = snapshot.curr
+                        AND e.effective > snapshot.period
+                        AND (e.effective, e.id) < (page_start.effective, page_start.id)
+                    ) since
+                    UNION ALL
+                    -- the entries in currencies without a snapshot
+                    SELECT e.curr, COALESCE(e.dr, 0), COALESCE(e.cr, 0)
+                    FROM entry e, page_start
+                    WHERE e.ledger_id = :ledger_id AND e.acct = :acct
+                    AND (e.effective, e.id) < (page_start.effective, page_start.id)
+                    AND e.curr NOT IN (SELECT curr FROM snapshot)
+                ) b
+                GROUP BY b.curr
+            )
+            SELECT page.id, page.tx, page.effective, t.posted, t.memo, page.curr,
+                page.dr, page.cr,
+                (
+                    COALESCE(opening.dr, 0) - COALESCE(opening.cr, 0)
+                    + sum(COALESCE(page.dr, 0) - COALESCE(page.cr, 0)) OVER (
+                        PARTITION BY page.curr ORDER BY page.effective, page.id
+                    )
+                ) * :normal AS balance
+            FROM page
+            JOIN transaction t ON t.ledger_id = :ledger_id AND t.id = page.tx
+            LEFT JOIN opening ON opening.curr = page.curr
+            ORDER BY page.effective, page.id
+        """
+
+    data = params.query_data() | {
+        "ledger_id": account["ledger_id"],
+        "acct": account["id"],
+        "normal": int(types.Normal(account["normal"])),
+    }
+    return await select_prepared(
+        conn, sql, build, data, key=("select_register", params.query_shape())
+    )
+
+
+@timed_query
+async def select_accounts(conn, sql: SQL, params: search.SearchParams):
+    results = await select_prepared(
+        conn,
+        sql,
+        lambda: sql.queries.SELECT(
+            "account",
+            fields=list(model.Account.model_fields),
+            filters=params.select_filters(),
+            **params.select_params(),
+        ),
         params.query_data(),
-        Constructor=model.Currency,
+        key=("select_accounts", params.query_shape()),
     )
-    return results
+    return params.order_results(results)
 
 
-async def select_ledgers(conn, sql: SQL, params: search.SearchParams):
-    query = sql.queries.SELECT(
-        "ledger", filters=params.select_filters(), **params.select_params()
+@timed_query
+async def select_currencies(conn, sql: SQL, params: search.SearchParams):
+    results = await select_prepared(
+        conn,
+        sql,
+        lambda: sql.queries.SELECT(
+            "currency",
+            fields=list(model.Currency.model_fields),
+            filters=params.select_filters(),
+            **params.select_params(),
+        ),
+        params.query_data(),
+        key=("select_currencies", params.query_shape()),
     )
-    results = await sql.select_all(
-        conn, query, params.query_data(), Constructor=model.Ledger
+    return params.order_results(results)
+
+
+@timed_query
+async def select_ledgers(conn, sql: SQL, params: search.SearchParams):
+    results = await select_prepared(
+        conn,
+        sql,
+        lambda: sql.queries.SELECT(
+            "ledger",
+            fields=list(model.Ledger.model_fields),
+            filters=params.select_filters(),
+            **params.select_params(),
+        ),
+        params.query_data(),
+        key=("select_ledgers", params.query_shape()),
     )
-    return results
+    return params.order_results(results)
 
 
+@timed_query
 async def select_transactions(conn, sql: SQL, params: search.SearchParams):
-    # select the transactions
-    where_cl = _get_where_clause(params)
-    tx_query = [
-        """
-        WITH tx_ids AS (
-            SELECT distinct(transaction.id)
+    """
+    Select the transactions matching the params, each with all its entries. The
+    transactions and entries are rows (dicts) of exactly the model fields (see
+    select_prepared).
+    """
+
+    # select the transactions (the entry filters are in an EXISTS semi-join, so the
+    # transactions can be ordered and limited without a join to entry)
+    def build_tx_query():
+        tx_fields = [
+            field for field in model.Transaction.model_fields if field != "entries"
+        ]
+        tx_query = [
+            f"""
+            SELECT {", ".join(f"transaction.{field}" for field in tx_fields)}
             FROM transaction
-            JOIN entry ON transaction.id = entry.tx
-        """,
-        "\n            ".join(where_cl),
-        """
-        )
-        SELECT transaction.*
-        FROM transaction
-        JOIN tx_ids ON tx_ids.id = transaction.id
-        """,
-    ]
-    tx_query.extend(_get_query_params(params))
+            """
+        ]
+        tx_query.extend(_get_where_clause(params))
+        tx_query.extend(_get_query_params(params))
+        return tx_query
 
-    tx_results = await sql.select_all(
-        conn, tx_query, params.query_data(), Constructor=model.Transaction
+    tx_results = await select_prepared(
+        conn,
+        sql,
+        build_tx_query,
+        params.query_data(),
+        key=("select_transactions", params.query_shape()),
     )
 
     # construct a dictionary of transactions by id
-    transactions = {tx.id: tx for tx in tx_results}
+    transactions = {tx["id"]: tx | {"entries": []} for tx in tx_results}
 
     # select corresponding entries
-    entries_query = """
-        SELECT e.*, a.name acct_name FROM entry e
-        JOIN transaction t ON e.tx = t.id
-        JOIN account a ON e.acct = a.id
-        WHERE t.id = ANY(:tx)
-    """
-    entries_params = {"tx": [tx_id for tx_id in transactions.keys()]}
+    def build_entries_query():
+        entry_fields = [
+            field for field in model.Entry.model_fields if field != "acct_name"
+        ]
+        return f"""
+            SELECT {", ".join(f"e.{field}" for field in entry_fields)},
+                a.name acct_name
+            FROM entry e
+            JOIN account a ON e.acct = a.id
+            WHERE e.ledger_id = ANY(:ledger_id)
+            AND e.tx = ANY(:tx)
+            ORDER BY e.id
+        """
+
+    # entries are partitioned by ledger_id (see the partition_by_ledger migration)
+    entries_params = {
+        "ledger_id": list({tx["ledger_id"] for tx in transactions.values()}),
+        "tx": list(transactions.keys()),
+    }
 
-    entries_results = await sql.select_all(
-        conn, entries_query, entries_params, Constructor=model.Entry
+    entries_results = await select_prepared(
+        conn,
+        sql,
+        build_entries_query,
+        entries_params,
+        key="select_transactions.entries",
     )
 
     # collate entries under their transactions
     for entry in entries_results:
-        transactions[entry.tx].entries.append(entry)
+        transactions[entry["tx"]]["entries"].append(entry)
 
     # select queries return lists
-    return list(transactions.values())
+    return params.order_results(list(transactions.values()))
+
+
+async def stream_transactions(
+    conn, sql: SQL, filters: list[str], data: dict, itersize: int = 1000
+):
+    """
+    Yield the transactions (with their entries) whose entries match the given filters,
+    in transaction order, as the rows arrive from a server-side cursor -- so that any
+    number of transactions can be streamed in constant memory. The filters apply to the
+    entries, with the table aliases e = entry, t = transaction, a = account, and should
+    include e.ledger_id, so that only that ledger's partition is scanned.
+    """
+    query = [
+        """
+        SELECT t.id tx, t.ledger_id, t.posted, t.effective, t.memo, t.meta,
+            t.idempotency_key,
+            e.id entry_id, e.acct, a.name acct_name, e.curr, e.dr, e.cr
+        FROM entry e
+        JOIN transaction t ON t.ledger_id = e.ledger_id AND t.id = e.tx
+        JOIN account a ON e.acct = a.id
+        """,
+        "WHERE " + "\nAND ".join(filters) if filters else "",
+        "ORDER BY e.tx, e.id",
+    ]
+    async with conn.cursor(name="stream_transactions", row_factory=dict_row) as cur:
+        cur.itersize = itersize
+        await cur.execute(*sql.render(query, data))
+
+        # collate entries under their transactions as the rows arrive
+        tx = None
+        async for row in cur:
+            if tx is None or tx.id != row["tx"]:
+                if tx is not None:
+                    yield tx
+                tx = model.Transaction(
+                    id=row["tx"],
+                    ledger_id=row["ledger_id"],
+                    posted=row["posted"],
+                    effective=row["effective"],
+                    memo=row["memo"],
+                    meta=row["meta"],
+                    idempotency_key=row["idempotency_key"],
+                )
+            tx.entries.append(
+                model.Entry(
+                    id=row["entry_id"],
+                    ledger_id=row["ledger_id"],
+                    tx=row["tx"],
+                    acct=row["acct"],
+                    acct_name=row["acct_name"],
+                    curr=row["curr"],
+                    dr=row["dr"],
+                    cr=row["cr"],
+                )
+            )
+        if tx is not None:
+            yield tx
@@ -0,0 +1,41 @@
+import asyncio
+import logging
+import random
+
+import psycopg_pool
+from psycopg.errors import DeadlockDetected, SerializationFailure
+
+from blackledger.metrics import COUNTERS
+
+LOG = logging.getLogger(__name__)
+
+# database errors that abort a transaction which can succeed if it is tried again
+RETRY_ERRORS = (DeadlockDetected, SerializationFailure)
+
+# errors that mean the database is unavailable for now: a transaction that has been
+# retried as many times as configured, or no database connection available in time
+UNAVAILABLE_ERRORS = (
+    *RETRY_ERRORS,
+    psycopg_pool.PoolTimeout,
+    psycopg_pool.TooManyRequests,
+)
+
+
+async def retry_transaction(func, name: str, attempts: int = 3, backoff: float = 0.01):
+    """
+    Await func() -- which runs one database transaction -- and return its result. If
+    the transaction is aborted by a deadlock or serialization failure, try it again (up
+    to the given number of attempts), after a random (jittered) exponential backoff.
+    Retries and failures are counted in the metrics COUNTERS, by name.
+    """
+    for attempt in range(1, attempts + 1):
+        try:
+            return await func()
+        except RETRY_ERRORS as exc:
+            error = exc.__class__.__name__
+            if attempt >= attempts:
+                COUNTERS[f"{name}.{error}.failed"] += 1
+                raise
+            COUNTERS[f"{name}.{error}.retried"] += 1
+            LOG.warning(f"{name}: {error} (attempt {attempt} of {attempts}); retrying")
+            await asyncio.sleep(random.uniform(0, backoff * 2**attempt))
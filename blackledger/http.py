@@ -4,18 +4,24 @@ from contextlib import asynccontextmanager
 from http import HTTPStatus
 from pathlib import Path
 
+import prometheus_client
 import psycopg_pool
-from fastapi import FastAPI
+from fastapi import FastAPI, Response
 from fastapi.staticfiles import StaticFiles
 from psycopg.errors import (
+    DeadlockDetected,
     ForeignKeyViolation,
     RaiseException,
+    SerializationFailure,
     UniqueViolation,
 )
 from pydantic import ValidationError
 from sqly import ASQL
 
 from blackledger import api
+from blackledger.db import pool
+from blackledger.metrics import PoolCollector, RequestMetricsMiddleware, render_metrics
+from blackledger.posting import PostingQueue
 from blackledger.response import JSONResponse
 from blackledger.settings import Settings
 
@@ -24,16 +30,42 @@ LOG = logging.getLogger(__name__)
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # create the database pool and SQL query engine
+    # create the database pools and SQL query engine
     app.sql = ASQL(dialect=app.settings.db.dialect)
-    app.pool = psycopg_pool.AsyncConnectionPool(
-        conninfo=app.settings.db.url.get_secret_value(), open=False
+    db = app.settings.db
+    app.pool = pool.create_pool(db, db.url.get_secret_value(), "blackledger")
+    app.read_pool = (
+        pool.create_pool(db, db.read_url.get_secret_value(), "blackledger-read")
+        if db.read_url
+        else app.pool
     )
-    await app.pool.open()
+    # warm up: open the pools' min_size connections before the app starts serving, and
+    # fail to start if the database can't be reached.
+    await app.pool.open(wait=True, timeout=db.pool_open_timeout)
+    if app.read_pool is not app.pool:
+        await app.read_pool.open(wait=True, timeout=db.pool_open_timeout)
+    app.pool_collector = PoolCollector(
+        {"primary": app.pool}
+        | ({"read": app.read_pool} if app.read_pool is not app.pool else {})
+    )
+    # start the posting queue's writer (group commit), if enabled
+    app.posting_queue = (
+        PostingQueue(app.pool, app.sql, db, lsn=app.read_pool is not app.pool)
+        if db.posting_queue
+        else None
+    )
+    if app.posting_queue:
+        app.posting_queue.start()
 
     yield
 
-    # close the database pool
+    # commit the queued transactions
+    if app.posting_queue:
+        await app.posting_queue.stop()
+
+    # close the database pools
+    if app.read_pool is not app.pool:
+        await app.read_pool.close()
     await app.pool.close()
 
 
@@ -42,11 +74,23 @@ PATH = Path(__file__).absolute().parent
 app = FastAPI(lifespan=lifespan)
 app.mount("/static", StaticFiles(directory=PATH / "ui" / "static"), name="static")
 app.include_router(api.router, prefix="/api", default_response_class=JSONResponse)
+app.add_middleware(RequestMetricsMiddleware)
 
 app.settings = Settings()
 logging.basicConfig(level=10 if app.settings.debug else 20)
 
 
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """
+    Export the metrics in the Prometheus text format (see blackledger.metrics).
+    """
+    return Response(
+        content=render_metrics(app.pool_collector),
+        media_type=prometheus_client.CONTENT_TYPE_LATEST,
+    )
+
+
 @app.exception_handler(NotImplementedError)
 async def not_implemented_error_handler(_, exc: NotImplementedError):
     LOG.critical(traceback.format_exc())
@@ -82,3 +126,18 @@ async def unique_violation_error_handler(_, exc: Exception):
         status_code=HTTPStatus.CONFLICT,
         content={"message": str(exc)},
     )
+
+
+@app.exception_handler(DeadlockDetected)
+@app.exception_handler(SerializationFailure)
+@app.exception_handler(psycopg_pool.PoolTimeout)
+@app.exception_handler(psycopg_pool.TooManyRequests)
+async def unavailable_error_handler(_, exc: Exception):
+    # raised when the transaction has been retried as many times as configured, or when
+    # no database connection is available in time.
+    LOG.warning(traceback.format_exc())
+    return JSONResponse(
+        status_code=HTTPStatus.SERVICE_UNAVAILABLE,
+        content={"message": str(exc)},
+        headers={"Retry-After": "1"},
+    )
@@ -0,0 +1,115 @@
+import csv
+from typing import AsyncIterator, Union
+
+import orjson
+
+# The CSV import has one row per entry, with the fields of its transaction -- the same
+# as the CSV export (see response.EXPORT_CSV_FIELDS), plus an optional idempotency_key.
+# Consecutive rows with the same `tx` are the entries of one transaction; `tx` only
+# groups the rows (the imported transactions get new ids), and the entry `id` and
+# `acct_name` are ignored.
+IMPORT_CSV_TRANSACTION_FIELDS = [
+    "ledger_id",
+    "posted",
+    "effective",
+    "memo",
+    "meta",
+    "idempotency_key",
+]
+IMPORT_CSV_ENTRY_FIELDS = ["ledger_id", "acct", "curr", "dr", "cr"]
+
+# The maximum size of a line (or a CSV record), so that a body without line breaks (or
+# with an unbalanced quote) isn't read into memory whole.
+IMPORT_MAX_RECORD_SIZE = 2**20
+
+
+class ImportFormatError(ValueError):
+    """
+    The import body can't be read: The rest of it can't be split into transactions.
+    """
+
+
+async def read_lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    """
+    Yield the lines of the streamed body as they arrive, without buffering the body.
+    """
+    buffer, number = b"", 0
+    async for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        if len(buffer) > IMPORT_MAX_RECORD_SIZE:
+            raise ImportFormatError(f"Line {number + len(lines) + 1} is too long")
+        for line in lines:
+            number += 1
+            yield _decode(line, number) + "\n"
+    if buffer:
+        yield _decode(buffer, number + 1)
+
+
+def _decode(line: bytes, number: int) -> str:
+    try:
+        return line.decode()
+    except UnicodeDecodeError as exc:
+        raise ImportFormatError(f"Line {number} is not valid UTF-8: {exc}")
+
+
+async def read_ndjson(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    """
+    Yield each (non-blank) line of a streamed NDJSON body: one transaction in JSON.
+    """
+    async for line in read_lines(chunks):
+        if line.strip():
+            yield line
+
+
+async def read_csv(chunks: AsyncIterator[bytes]) -> AsyncIterator[dict]:
+    """
+    Yield the transaction data (with its entries) of each group of rows of a streamed
+    CSV body (see IMPORT_CSV_TRANSACTION_FIELDS). Empty values are null. Every row must
+    have a `tx`, which groups the rows: Otherwise the whole body would be one
+    transaction.
+    """
+    header, record, key, transaction, number = None, "", None, None, 0
+    async for line in read_lines(chunks):
+        number += 1
+        # a quoted value can span lines: read until the quotes are balanced
+        record += line
+        if record.count('"') % 2:
+            if len(record) > IMPORT_MAX_RECORD_SIZE:
+                raise ImportFormatError(f"Line {number}: The record is too long")
+            continue
+        row, record = next(csv.reader([record]), []), ""
+        if not any(row):
+            continue
+        if header is None:
+            if "tx" not in row:
+                raise ImportFormatError("The CSV header must have a tx column")
+            header = row
+            continue
+
+        values = {field: value or None for field, value in zip(header, row)}
+        if not values.get("tx"):
+            raise ImportFormatError(f"Line {number}: The row must have a tx")
+        entry = {field: values.get(field) for field in IMPORT_CSV_ENTRY_FIELDS}
+        if transaction is not None and values.get("tx") == key:
+            transaction["entries"].append(entry)
+            continue
+        if transaction is not None:
+            yield transaction
+        key = values.get("tx")
+        transaction = {
+            field: values.get(field) for field in IMPORT_CSV_TRANSACTION_FIELDS
+        } | {"entries": [entry]}
+        if transaction["meta"]:
+            transaction["meta"] = _json_value(transaction["meta"])
+
+    if transaction is not None:
+        yield transaction
+
+
+def _json_value(value: str) -> Union[dict, str]:
+    # (invalid JSON is left as it is, to fail validation)
+    try:
+        return orjson.loads(value)
+    except orjson.JSONDecodeError:
+        return value
@@ -0,0 +1,167 @@
+"""
+Prometheus metrics, exported by the /metrics endpoint:
+
+* blackledger_request_duration_seconds = HTTP request latency by method, route and
+  status (so the counts by status include the posting errors: 404, 409, 412, 422).
+* blackledger_db_query_duration_seconds = database query latency by query function
+  (see `timed_query`).
+* blackledger_transaction_entries = the number of entries per posted transaction.
+* blackledger_transaction_results_total = the results of the transactions in posted
+  batches, by status.
+* blackledger_pool_* = the database connection pool statistics, including the time
+  spent waiting for a connection (see `PoolCollector`).
+* blackledger_events_total = the COUNTERS of notable events, by name.
+
+With several worker processes, set PROMETHEUS_MULTIPROC_DIR so that the histograms and
+counters are aggregated across the workers. (The pool statistics and event counters are
+those of the worker process that serves the request.)
+"""
+
+import os
+import time
+from collections import Counter
+from functools import wraps
+from http import HTTPStatus
+
+import prometheus_client
+from prometheus_client import multiprocess
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+# In-process counts of notable events, by name (such as the database transactions that
+# were retried), for monitoring.
+COUNTERS = Counter()
+
+REQUEST_SECONDS = prometheus_client.Histogram(
+    "blackledger_request_duration_seconds",
+    "HTTP request latency by route",
+    ["method", "route", "status"],
+)
+QUERY_SECONDS = prometheus_client.Histogram(
+    "blackledger_db_query_duration_seconds",
+    "Database query latency by query function",
+    ["query"],
+)
+TRANSACTION_ENTRIES = prometheus_client.Histogram(
+    "blackledger_transaction_entries",
+    "Entries per posted transaction",
+    buckets=[2, 3, 4, 6, 8, 12, 16, 32, 64, 128, 256],
+)
+TRANSACTION_RESULTS = prometheus_client.Counter(
+    "blackledger_transaction_results",
+    "Results of the transactions in posted batches, by status",
+    ["status"],
+)
+
+
+class RequestMetricsMiddleware:
+    """
+    ASGI middleware that observes the latency of each HTTP request in REQUEST_SECONDS,
+    by route, once its response has been sent completely (including the body of a
+    streaming response). A request that raises an exception is observed as a 500.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        start = time.perf_counter()
+        status = HTTPStatus.INTERNAL_SERVER_ERROR
+
+        async def send_response(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_response)
+        finally:
+            # (the route is set in the scope by the router that matched it)
+            route = scope.get("route")
+            REQUEST_SECONDS.labels(
+                method=scope["method"],
+                route=route.path if route else "(unmatched)",
+                status=int(status),
+            ).observe(time.perf_counter() - start)
+
+
+def timed_query(func):
+    """
+    Decorate an async query function so that its duration is observed in QUERY_SECONDS,
+    labeled with the function name.
+    """
+    histogram = QUERY_SECONDS.labels(query=func.__name__)
+
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        with histogram.time():
+            return await func(*args, **kwargs)
+
+    return wrapper
+
+
+class PoolCollector:
+    """
+    Collect the statistics of the given database connection pools ({name: pool}) when
+    the metrics are scraped, along with the event COUNTERS.
+    """
+
+    # (psycopg_pool get_stats() key, metric name, type, scale, description)
+    POOL_STATS = [
+        ("pool_size", "size", "gauge", 1, "Connections in the pool"),
+        ("pool_available", "available", "gauge", 1, "Idle connections in the pool"),
+        ("requests_waiting", "requests_waiting", "gauge", 1, "Requests waiting"),
+        ("requests_num", "requests", "counter", 1, "Connection requests"),
+        ("requests_queued", "requests_queued", "counter", 1, "Requests queued"),
+        ("requests_errors", "requests_errors", "counter", 1, "Requests failed"),
+        (
+            "requests_wait_ms",
+            "requests_wait_seconds",
+            "counter",
+            0.001,
+            "Time spent waiting for a connection",
+        ),
+        ("connections_num", "connections", "counter", 1, "Connections opened"),
+        ("connections_errors", "connections_errors", "counter", 1, "Failed connects"),
+    ]
+
+    def __init__(self, pools: dict):
+        self.pools = pools
+
+    def collect(self):
+        stats = {name: pool.get_stats() for name, pool in self.pools.items()}
+        for key, name, kind, scale, description in self.POOL_STATS:
+            Family = GaugeMetricFamily if kind == "gauge" else CounterMetricFamily
+            family = Family(f"blackledger_pool_{name}", description, labels=["pool"])
+            for pool_name, pool_stats in stats.items():
+                family.add_metric([pool_name], pool_stats.get(key, 0) * scale)
+            yield family
+
+        events = CounterMetricFamily(
+            "blackledger_events", "Notable events, by name", labels=["event"]
+        )
+        for event, count in COUNTERS.items():
+            events.add_metric([event], count)
+        yield events
+
+
+def render_metrics(*collectors) -> bytes:
+    """
+    Render the metrics, along with those of the given collectors (such as a
+    PoolCollector), in the Prometheus text format.
+    """
+    registry = prometheus_client.REGISTRY
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+
+    collectors_registry = prometheus_client.CollectorRegistry(auto_describe=False)
+    for collector in collectors:
+        collectors_registry.register(collector)
+
+    return prometheus_client.generate_latest(
+        registry
+    ) + prometheus_client.generate_latest(collectors_registry)
@@ -1,7 +1,7 @@
 from datetime import datetime
 from decimal import Decimal
 from random import randint
-from typing import Optional
+from typing import Any, Optional
 
 import orjson
 from pydantic import (
@@ -52,6 +52,8 @@ class Account(Model):
     normal: NormalField
     number: Optional[int] = None
     version: Optional[BigIDField] = None
+    # the number of balance shards for a hot account (0 = not sharded)
+    shards: int = Field(default=0, ge=0, le=256)
 
 
 class AccountBalances(Model):
@@ -114,6 +116,7 @@ class Transaction(Model):
     effective: Optional[datetime] = None
     memo: Optional[str] = None
     meta: Optional[dict] = None
+    idempotency_key: Optional[types.IdempotencyKey] = None
     entries: list[Entry] = Field(default_factory=list)
 
     @model_validator(mode="after")
@@ -153,12 +156,58 @@ class NewTransaction(Transaction):
         """
         If the individual entries in the transaction don't have ledger_id, fill it in.
         """
-        for entry in filter(lambda e: not e.get("ledger_id"), values["entries"]):
-            entry["ledger_id"] = values.get("ledger_id")
+        if isinstance(values, dict):
+            for entry in values.get("entries") or []:
+                if isinstance(entry, dict) and not entry.get("ledger_id"):
+                    entry["ledger_id"] = values.get("ledger_id")
 
         return values
 
 
+class TransactionResult(Model):
+    """
+    The result of posting one transaction in a batch: The index of the transaction in
+    the batch, the HTTP status of the result, and either the id of the posted
+    transaction or the error detail.
+    """
+
+    index: int
+    status: int
+    id: Optional[BigIDField] = None
+    detail: Optional[Any] = None
+    # the posted transaction, and the LSN of its commit (if there is a read replica),
+    # for the posting queue (not serialized)
+    transaction: Optional[Transaction] = Field(default=None, exclude=True)
+    lsn: Optional[str] = Field(default=None, exclude=True)
+
+
+class ImportResult(Model):
+    """
+    The result of an import: The number of transactions imported, and the result of
+    each transaction that wasn't (see TransactionResult).
+    """
+
+    imported: int
+    results: list[TransactionResult] = Field(default_factory=list)
+
+
+class RegisterEntry(Model):
+    """
+    An entry in an account register, with its transaction's posted time and memo, and
+    the account's (running) balance in the entry's currency after the entry.
+    """
+
+    id: BigIDField
+    tx: BigIDField
+    effective: datetime
+    posted: datetime
+    memo: Optional[str] = None
+    curr: types.CurrencyCode
+    dr: Optional[Decimal] = None
+    cr: Optional[Decimal] = None
+    balance: Decimal
+
+
 class Ledger(Model):
     id: Optional[BigIDField] = None
     name: types.Name
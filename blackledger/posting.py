@@ -0,0 +1,335 @@
+"""
+Posting transactions in chunks (batches and posting queue groups), and the posting queue
+(group commit).
+"""
+
+import asyncio
+import logging
+from http import HTTPStatus
+
+import psycopg
+from fastapi import HTTPException
+from psycopg.errors import ForeignKeyViolation, RaiseException, UniqueViolation
+
+from blackledger import model
+from blackledger.db import queries
+from blackledger.db.pool import current_lsn
+from blackledger.db.retry import retry_transaction
+from blackledger.metrics import COUNTERS
+from blackledger.settings import DatabaseSettings
+
+LOG = logging.getLogger(__name__)
+
+# database errors that mean a transaction conflicts with the data in the ledger
+CONFLICT_ERRORS = (ForeignKeyViolation, RaiseException, UniqueViolation)
+
+
+async def post_transactions_chunk(conn, sql, items: list):
+    """
+    Post a chunk of (index, NewTransaction) items in one database transaction, returning
+    a TransactionResult for each item. The whole chunk is inserted at once; if that
+    fails, each item is checked and inserted in turn, in its own savepoint, to isolate
+    the failures: 409 for a conflict, 422 for another error caused by the item's data,
+    and 200 with the id of the posted transaction for an idempotency key that a
+    concurrent request posted first. Either way, each item's account versions are
+    checked as they stand after the earlier items in the chunk (see
+    `update_accounts_versions()`).
+    """
+    results = []
+    async with conn.transaction():
+        # items with idempotency keys that have already been posted are not posted
+        # again, and neither are items that repeat a key earlier in the chunk.
+        posted_keys = await queries.select_transaction_ids_by_key(
+            conn,
+            sql,
+            list(
+                {
+                    (item.ledger_id, item.idempotency_key)
+                    for _, item in items
+                    if item.idempotency_key
+                }
+            ),
+        )
+        chunk_keys, repeated_items, new_items = {}, [], []
+        for index, item in items:
+            key = (item.ledger_id, item.idempotency_key)
+            if item.idempotency_key and key in posted_keys:
+                results.append(
+                    model.TransactionResult(
+                        index=index, status=HTTPStatus.OK, id=posted_keys[key]
+                    )
+                )
+            elif item.idempotency_key and key in chunk_keys:
+                repeated_items.append((index, key))
+            else:
+                if item.idempotency_key:
+                    chunk_keys[key] = index
+                new_items.append((index, item))
+
+        accts_versions = await queries.select_account_versions(
+            conn, sql, [e.acct for _, item in new_items for e in item.entries]
+        )
+        # check every item first, with the versions that the earlier items would
+        # create, and insert the valid items at once
+        versions = dict(accts_versions)
+        valid_items, invalid_results = [], []
+        for index, item in new_items:
+            try:
+                check_accounts_versions(item, versions)
+            except HTTPException as exc:
+                invalid_results.append(
+                    model.TransactionResult(
+                        index=index, status=exc.status_code, detail=exc.detail
+                    )
+                )
+                continue
+            valid_items.append((index, item))
+            update_accounts_versions(versions, item.entries)
+
+        try:
+            async with conn.transaction():
+                transactions = await queries.insert_transactions(
+                    conn, sql, [item for _, item in valid_items]
+                )
+        except psycopg.OperationalError:
+            # (caused by the database or the connection, not by an item: including
+            # deadlocks and serialization failures, which retry the chunk)
+            raise
+        except psycopg.Error:
+            # (caused by an item: a conflict, or its data, such as a NUL in a memo)
+            transactions = None
+
+        if transactions is not None:
+            results += invalid_results
+            results += [
+                model.TransactionResult(
+                    index=index, status=HTTPStatus.CREATED, id=tx.id, transaction=tx
+                )
+                for (index, _), tx in zip(valid_items, transactions)
+            ]
+        else:
+            # check and insert each item in turn, with the versions that the earlier
+            # items actually created
+            versions = dict(accts_versions)
+            for index, item in new_items:
+                try:
+                    check_accounts_versions(item, versions)
+                    async with conn.transaction():
+                        tx = await queries.insert_transaction(conn, sql, item)
+                except HTTPException as exc:
+                    results.append(
+                        model.TransactionResult(
+                            index=index, status=exc.status_code, detail=exc.detail
+                        )
+                    )
+                except UniqueViolation as exc:
+                    # a concurrent request with the same idempotency key posted it
+                    # first: a replay of that transaction
+                    key = (item.ledger_id, item.idempotency_key)
+                    posted_keys = (
+                        await queries.select_transaction_ids_by_key(conn, sql, [key])
+                        if item.idempotency_key
+                        else {}
+                    )
+                    results.append(
+                        model.TransactionResult(
+                            index=index, status=HTTPStatus.OK, id=posted_keys[key]
+                        )
+                        if key in posted_keys
+                        else model.TransactionResult(
+                            index=index, status=HTTPStatus.CONFLICT, detail=str(exc)
+                        )
+                    )
+                except CONFLICT_ERRORS as exc:
+                    results.append(
+                        model.TransactionResult(
+                            index=index, status=HTTPStatus.CONFLICT, detail=str(exc)
+                        )
+                    )
+                except psycopg.OperationalError:
+                    raise
+                except psycopg.Error as exc:
+                    results.append(
+                        model.TransactionResult(
+                            index=index,
+                            status=HTTPStatus.UNPROCESSABLE_ENTITY,
+                            detail=str(exc),
+                        )
+                    )
+                else:
+                    results.append(
+                        model.TransactionResult(
+                            index=index,
+                            status=HTTPStatus.CREATED,
+                            id=tx.id,
+                            transaction=tx,
+                        )
+                    )
+                    update_accounts_versions(versions, tx.entries)
+
+        # repeated items have the result of the first item with the same key
+        results_by_index = {result.index: result for result in results}
+        for index, key in repeated_items:
+            result = results_by_index[chunk_keys[key]]
+            status = HTTPStatus.OK if result.id else result.status
+            results.append(result.model_copy(update={"index": index, "status": status}))
+
+    return results
+
+
+def check_accounts_versions(item: model.NewTransaction, accts_versions: dict):
+    """
+    Ensure that every entry account exists, and that each entry's version, if given, is
+    equal to the latest entry for that account (OPTIONAL optimistic locking /
+    concurrency control). Only the first entry for each account is checked: Later
+    entries for the same account follow from the version created by the earlier entry.
+    Sharded (hot) accounts are not versioned, so their entries can't have a version.
+    """
+    checked_accts = set()
+    for entry_item in item.entries:
+        if entry_item.acct not in accts_versions:
+            raise HTTPException(
+                status_code=HTTPStatus.NOT_FOUND,
+                detail=f"Account not found: {entry_item.acct}",
+            )
+        if entry_item.acct in checked_accts:
+            continue
+        account = accts_versions[entry_item.acct]
+        if entry_item.version and account["shards"]:
+            raise HTTPException(
+                status_code=HTTPStatus.PRECONDITION_FAILED,
+                detail="Entry account_version is not supported for sharded accounts",
+            )
+        if entry_item.version and account["version"] != entry_item.version:
+            raise HTTPException(
+                status_code=HTTPStatus.PRECONDITION_FAILED,
+                detail="Entry account_version is out of date",
+            )
+        checked_accts.add(entry_item.acct)
+
+
+def update_accounts_versions(accts_versions: dict, entries: list[model.Entry]):
+    """
+    Update accts_versions (in place, without changing its values) with the versions
+    that the given entries create: each account's latest entry id. An entry that hasn't
+    been inserted has no id yet, so the version it creates is unknown, and any version
+    given for the account after it is out of date.
+    """
+    for entry in entries:
+        accts_versions[entry.acct] = accts_versions[entry.acct] | {"version": entry.id}
+
+
+class PostingQueue:
+    """
+    Group commit for posted transactions: Requests put their (validated) transactions
+    on the queue and await their results, while a background writer commits the queued
+    transactions in groups -- one database transaction (and one commit, and fsync) per
+    group rather than per request. Each group is posted like a batch (see
+    `post_transactions_chunk()`), so each transaction still has its own result: its
+    account and version checks, balancing, idempotency key, and conflicts are the same
+    as if it had been posted alone, in the order it was queued. (In particular, its
+    entry versions are checked against the accounts as they stand after the earlier
+    transactions in the group.)
+
+    The writer doesn't wait for a group to fill: it commits whatever is queued (up to
+    `posting_group_size`), so that groups form on their own when requests arrive faster
+    than they can be committed. `posting_group_delay` makes it wait for more.
+
+    A transaction that has been queued is posted even if its request is cancelled (use
+    idempotency keys to retry safely). When the queue is full, requests fail with 503.
+    """
+
+    def __init__(self, pool, sql, settings: DatabaseSettings, lsn: bool = False):
+        self.pool = pool
+        self.sql = sql
+        self.settings = settings
+        self.lsn = lsn  # whether to return the LSN of each commit (for read replicas)
+        self.queue = asyncio.Queue(maxsize=settings.posting_queue_max)
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.create_task(self.write())
+
+    async def stop(self):
+        """
+        Stop the writer once it has committed the transactions that are queued.
+        """
+        await self.queue.put(None)
+        await self.task
+
+    async def post(self, item: model.NewTransaction) -> model.TransactionResult:
+        """
+        Queue the transaction and return its result once its group is committed. Raise
+        the error if the group could not be committed.
+        """
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self.queue.put_nowait((item, future))
+        except asyncio.QueueFull:
+            COUNTERS["posting_queue.full"] += 1
+            raise HTTPException(
+                status_code=HTTPStatus.SERVICE_UNAVAILABLE,
+                detail="The posting queue is full",
+                headers={"Retry-After": "1"},
+            )
+        return await future
+
+    async def write(self):
+        """
+        Commit the queued transactions in groups until stopped.
+        """
+        stopped = False
+        while not stopped:
+            group = [await self.queue.get()]
+            deadline = (
+                asyncio.get_running_loop().time() + self.settings.posting_group_delay
+            )
+            while (
+                group[-1] is not None and len(group) < self.settings.posting_group_size
+            ):
+                try:
+                    group.append(self.queue.get_nowait())
+                    continue
+                except asyncio.QueueEmpty:
+                    pass
+                timeout = deadline - asyncio.get_running_loop().time()
+                if timeout <= 0:
+                    break
+                try:
+                    group.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            if group[-1] is None:
+                stopped = True
+                group.pop()
+            if group:
+                await self.commit(group)
+
+    async def commit(self, group: list):
+        """
+        Post the group of (item, future) in one database transaction, and set each
+        future's result: its TransactionResult (with the LSN of the commit, if
+        `self.lsn`), or the error that aborted the group.
+        """
+        COUNTERS["posting_queue.groups"] += 1
+        items = [(index, item) for index, (item, _) in enumerate(group)]
+        try:
+            async with self.pool.connection() as conn:
+                results = await retry_transaction(
+                    lambda: post_transactions_chunk(conn, self.sql, items),
+                    "posting_queue",
+                    attempts=self.settings.retry_attempts,
+                )
+                lsn = await current_lsn(self.sql, conn) if self.lsn else None
+        except Exception as exc:
+            LOG.exception(f"posting_queue: group of {len(group)} failed")
+            for _, future in group:
+                if not future.done():
+                    future.set_exception(exc)
+            return
+
+        for result in results:
+            future = group[result.index][1]
+            if not future.done():  # (the request was cancelled)
+                future.set_result(result.model_copy(update={"lsn": lsn}))
@@ -1,25 +1,107 @@
-import json
-from datetime import datetime
-from typing import Any
+import csv
+import io
+from decimal import Decimal
+from typing import Any, AsyncIterator
 
 import fastapi.responses
+import orjson
+from pydantic import BaseModel
 
+from blackledger import model, types
 
-class JsonEncoder(json.JSONEncoder):
-    def default(self, obj: Any):
-        if isinstance(obj, datetime):
-            return obj.isoformat()
-        else:
-            return super().default(obj)
+
+def orjson_default(obj: Any):
+    """
+    Serialize the types that orjson doesn't handle natively (it handles datetime, Enum,
+    dataclass, etc.): Decimal as a string (exactly, as pydantic does), and pydantic
+    models as their JSON, serialized by pydantic (once: it is included as it is, rather
+    than dumped to a dict that orjson serializes again).
+    """
+    if isinstance(obj, Decimal):
+        return str(obj)
+    elif isinstance(obj, BaseModel):
+        return orjson.Fragment(obj.model_dump_json())
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
 
 
 class JSONResponse(fastapi.responses.JSONResponse):
     def render(self, content: Any) -> bytes:
-        return json.dumps(
+        # (UTC datetimes end in "Z", as they do when serialized by pydantic)
+        return orjson.dumps(
             content,
-            ensure_ascii=False,
-            allow_nan=False,
-            indent=None,
-            separators=(",", ":"),
-            cls=JsonEncoder,
-        ).encode("utf-8")
+            default=orjson_default,
+            option=orjson.OPT_NON_STR_KEYS | orjson.OPT_UTC_Z,
+        )
+
+
+# one CSV row per entry, with the fields of its transaction
+EXPORT_CSV_FIELDS = [
+    "tx",
+    "ledger_id",
+    "posted",
+    "effective",
+    "memo",
+    "meta",
+    "id",
+    "acct",
+    "acct_name",
+    "curr",
+    "dr",
+    "cr",
+]
+
+
+async def _export_ndjson(transactions: AsyncIterator[model.Transaction]):
+    async for tx in transactions:
+        yield tx.model_dump_json() + "\n"
+
+
+async def _export_csv(transactions: AsyncIterator[model.Transaction]):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_CSV_FIELDS)
+    async for tx in transactions:
+        for entry in tx.entries:
+            writer.writerow(
+                [
+                    tx.id,
+                    tx.ledger_id,
+                    tx.posted.isoformat(),
+                    tx.effective.isoformat(),
+                    tx.memo,
+                    orjson.dumps(tx.meta).decode() if tx.meta is not None else None,
+                    entry.id,
+                    entry.acct,
+                    entry.acct_name,
+                    entry.curr,
+                    entry.dr,
+                    entry.cr,
+                ]
+            )
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+def export_response(
+    transactions: AsyncIterator[model.Transaction],
+    format: types.ExportFormat,
+    filename: str,
+) -> fastapi.responses.StreamingResponse:
+    """
+    Stream the given transactions as NDJSON (one transaction per line) or CSV (one entry
+    per row) as they are produced, with a Content-Disposition for the given filename.
+    """
+    if format == types.ExportFormat.CSV:
+        content, media_type = _export_csv(transactions), "text/csv"
+    else:
+        content, media_type = _export_ndjson(transactions), "application/x-ndjson"
+
+    return fastapi.responses.StreamingResponse(
+        content,
+        media_type=media_type,
+        headers={
+            "Content-Disposition": (f'attachment; filename="{filename}.{format.value}"')
+        },
+    )
@@ -1,12 +1,32 @@
-from typing import Optional
+import base64
+from typing import Any, ClassVar, Optional
 
-from pydantic import Field
+import orjson
+from pydantic import Field, field_validator, model_validator
 from sqly import Q
 
 from blackledger.model import Model
 
 
+def encode_cursor(value: Any) -> str:
+    """
+    Encode the value of a cursor key as an opaque (url-safe) cursor token.
+    """
+    return base64.urlsafe_b64encode(orjson.dumps(value)).decode().rstrip("=")
+
+
+def decode_cursor(token: str) -> Any:
+    """
+    Decode a cursor token to the value of the cursor key.
+    """
+    return orjson.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+
+
 class SearchParams(Model):
+    # the (unique, ordered) key that cursors are based on, and the type of its values
+    cursor_key: ClassVar[str] = "id"
+    cursor_type: ClassVar[type] = int
+
     orderby: Optional[str] = Field(
         default=None,
         pattern=r"^-?\w+(,\-?\w+)*$",
@@ -15,13 +35,43 @@ class SearchParams(Model):
     )
     limit: Optional[int] = Field(default=100, le=100, alias="_limit")
     offset: Optional[int] = Field(default=None, alias="_offset")
+    after: Optional[str] = Field(default=None, alias="_after")
+    before: Optional[str] = Field(default=None, alias="_before")
+
+    @field_validator("after", "before")
+    @classmethod
+    def check_cursor(cls, value):
+        # (the cursor is passed to the query as it is, so its type must be checked)
+        try:
+            cursor = decode_cursor(value)
+            assert isinstance(cursor, cls.cursor_type) and not isinstance(cursor, bool)
+        except Exception:
+            raise ValueError("invalid cursor")
+        return value
+
+    @model_validator(mode="after")
+    def check_cursor_params(self):
+        """
+        Cursors page through the results in the order of the cursor key, so they can
+        only be used when ordering by that key, and _after and _before are exclusive.
+        """
+        if self.after or self.before:
+            assert not (self.after and self.before), "use either _after or _before"
+            assert self.orderby in [
+                None,
+                self.cursor_key,
+                f"-{self.cursor_key}",
+            ], f"_after and _before require ordering by {self.cursor_key}"
+        return self
 
     def select_params(self):
-        params = {
-            k.lstrip("_"): v
-            for k, v in self.model_dump(exclude_none=True, by_alias=True).items()
-            if k.startswith("_")
-        }
+        # The limit and offset are bound as query parameters (see query_data), so that
+        # the query text doesn't depend on their values.
+        params = {}
+        if self.limit:
+            params["limit"] = ":_limit"
+        if self.offset:
+            params["offset"] = ":_offset"
         if self.orderby:
             params["orderby"] = ",".join(
                 [
@@ -29,6 +79,10 @@ class SearchParams(Model):
                     for field in [field.strip() for field in self.orderby.split(",")]
                 ]
             )
+        if self.after or self.before:
+            # _before pages are selected in reverse order (see order_results)
+            descending = self.cursor_descending() != bool(self.before)
+            params["orderby"] = f"{self.cursor_key}{' desc' if descending else ''}"
         return params
 
     def select_filters(self):
@@ -41,12 +95,88 @@ class SearchParams(Model):
                     op="~*" if isinstance(val, str) else "=",
                 )
             )
-            for key, val in self.query_data().items()
+            for key, val in self.filter_data().items()
+        ] + self.cursor_filters()
+
+    def cursor_filters(self, key: Optional[str] = None):
+        """
+        The keyset filter for the cursor, if any, on the given key (default:
+        cursor_key), which can be qualified with its table name.
+        """
+        if not (self.after or self.before):
+            return []
+        greater = self.cursor_descending() == bool(self.before)
+        return [f"{key or self.cursor_key} {'>' if greater else '<'} :cursor"]
+
+    def cursor_descending(self):
+        return self.orderby == f"-{self.cursor_key}"
+
+    def order_results(self, results: list) -> list:
+        """
+        Put the results of a query with these params in the requested order: _before
+        pages are selected in reverse order, so they must be reversed.
+        """
+        return list(reversed(results)) if self.before else results
+
+    def cursor_links(self, url, results: list) -> Optional[str]:
+        """
+        Return a Link header value with the "next" and "prev" cursor links for the given
+        results of these params, or None if there are no such pages. Cursor links are
+        only available when the results are ordered by the cursor key, and the "prev"
+        link only when the results are a page that was requested with a cursor.
+        """
+        cursor_orderby = [self.cursor_key, f"-{self.cursor_key}"]
+        if not (self.after or self.before or self.orderby in cursor_orderby):
+            return None
+
+        values = [
+            result[self.cursor_key]
+            if isinstance(result, dict)
+            else getattr(result, self.cursor_key)
+            for result in results
         ]
+        url = url.remove_query_params(["_after", "_before", "_offset"])
+        links = []
+        if values and (self.before or (self.limit and len(values) >= self.limit)):
+            next_url = url.include_query_params(_after=encode_cursor(values[-1]))
+            links.append(f'<{next_url}>; rel="next"')
+        if values and (self.after or self.before):
+            prev_url = url.include_query_params(_before=encode_cursor(values[0]))
+            links.append(f'<{prev_url}>; rel="prev"')
+        return ", ".join(links) or None
 
-    def query_data(self):
+    def query_shape(self) -> tuple:
+        """
+        A hashable key for everything that the text of a query with these params depends
+        on -- the filters and their types, the ordering, whether there is a limit and
+        offset, and the cursor direction -- but not the values of the query parameters
+        (including the limit and offset), so that the query can be built once and
+        cached for each shape (see db.queries.render_query).
+        """
+        return (
+            self.__class__.__name__,
+            tuple(
+                (key, type(val).__name__)
+                for key, val in sorted(self.filter_data().items())
+            ),
+            tuple(sorted(self.select_params().items())),
+            bool(self.after),
+            bool(self.before),
+        )
+
+    def filter_data(self):
         return {
             k: v
             for k, v in self.model_dump(exclude_none=True, by_alias=True).items()
             if not k.startswith("_")
         }
+
+    def query_data(self):
+        data = self.filter_data()
+        if self.limit:
+            data["_limit"] = self.limit
+        if self.offset:
+            data["_offset"] = self.offset
+        if self.after or self.before:
+            data["cursor"] = decode_cursor(self.after or self.before)
+        return data
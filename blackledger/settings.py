@@ -7,6 +7,28 @@ from pydantic_settings import BaseSettings, SettingsConfigDict
 class DatabaseSettings(BaseSettings):
     url: SecretStr
     dialect: str
+    read_url: Optional[SecretStr] = None  # If set, read-only requests use this database
+    read_lsn_timeout: float = 1.0  # Seconds to wait for the replica to replay a write.
+    retry_attempts: int = 3  # Attempts for transactions aborted by deadlocks etc.
+    prepare: bool = True  # Use prepared statements (disable for transaction poolers)
+
+    # Connection pool (per worker process): Size the pool so that workers * max_size
+    # stays within the database's max_connections.
+    pool_min_size: int = 4  # Connections kept open, and opened before starting.
+    pool_max_size: Optional[int] = None  # Max connections (default: pool_min_size).
+    pool_timeout: float = 30.0  # Seconds a request waits for a connection.
+    pool_max_waiting: int = 0  # Max requests waiting for a connection (0 = no limit).
+    pool_max_idle: float = 600.0  # Seconds before an idle connection is closed.
+    pool_max_lifetime: float = 3600.0  # Seconds before a connection is replaced.
+    pool_check: bool = True  # Check that each connection is alive before using it.
+    pool_open_timeout: float = 30.0  # Seconds to wait for the pool to open (warm-up).
+
+    # Posting queue (group commit): Posted transactions are queued and committed in
+    # groups by a background writer, rather than in a database transaction per request.
+    posting_queue: bool = False
+    posting_group_size: int = 100  # Max transactions committed together.
+    posting_group_delay: float = 0.0  # Seconds to wait for more (0 = only the queued).
+    posting_queue_max: int = 10000  # Max queued transactions (0 = no limit).
 
     model_config = SettingsConfigDict(env_prefix="DATABASE_")
 
@@ -17,6 +39,10 @@ class AuthSettings(BaseSettings):
     issuer: str
     algorithm: str = "RS256"
     audience: Optional[str] = None  # If set, authentication will validate the audience.
+    jwks_lifespan: int = 300  # Seconds to trust the JWKS keys before fetching again.
+    jwks_refresh_interval: int = 30  # Min seconds between fetches (for unknown kids).
+    jwks_timeout: int = 5  # Seconds to wait for the JWKS to be fetched.
+    token_cache_size: int = 1024  # Max verified tokens to cache (0 = no caching).
 
     model_config = SettingsConfigDict(env_prefix="AUTH_")
 
@@ -1,6 +1,130 @@
+import asyncio
+import json
+from datetime import datetime, timezone
+from decimal import Decimal
 from http import HTTPStatus
 
+import prometheus_client
+from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
+from fastapi.testclient import TestClient
+
+from blackledger import model, types
+from blackledger.api.accounts import AccountParams
+from blackledger.db import queries
+from blackledger.http import app
+from blackledger.metrics import RequestMetricsMiddleware
+from blackledger.response import JSONResponse
+
 
 def test_home(client):
     response = client.get("/api")
     assert response.status_code == HTTPStatus.OK
+
+
+def test_json_response_render():
+    """
+    JSONResponse renders Decimal (exactly, as a string), datetime, Enum and pydantic
+    models.
+    """
+    content = {
+        "amount": Decimal("1000.10"),
+        "posted": datetime(2024, 1, 2, 3, 4, 5, tzinfo=timezone.utc),
+        "normal": types.Normal.CR,
+        "currency": model.Currency(code="USD"),
+    }
+    assert json.loads(JSONResponse(content=content).body) == {
+        "amount": "1000.10",
+        "posted": "2024-01-02T03:04:05Z",
+        "normal": "CR",
+        "currency": {"code": "USD"},
+    }
+
+
+def test_render_query_cached_by_shape(sql):
+    """
+    Search queries are built and rendered once for each shape of their params, which
+    doesn't depend on the values of the params.
+    """
+    built = []
+
+    def render(params):
+        def build():
+            built.append(params)
+            return [
+                "SELECT * FROM account",
+                *queries._get_where_clause(params),
+                *queries._get_query_params(params),
+            ]
+
+        return queries.render_query(
+            sql, build, params.query_data(), key=("test", params.query_shape())
+        )
+
+    params = [
+        AccountParams.model_validate(data)
+        for data in [
+            {"name": "Asset", "_limit": 10},
+            {"name": "Income", "_limit": 10},
+            {"name": "Asset", "_limit": 20},
+            {"id": "1,2", "_limit": 10},
+        ]
+    ]
+    rendered = [render(p) for p in params]
+    assert rendered[0] == rendered[1] == rendered[2]
+    assert len(built) == 2
+    assert "%(name)s" in rendered[0]
+    assert "LIMIT %(_limit)s" in rendered[0]
+    assert "%(id)s" in rendered[3]
+
+
+def test_stats(client):
+    response = client.get("/api/stats")
+    assert response.status_code == HTTPStatus.OK
+    data = response.json()
+    assert data["pool"]["pool_min"] == app.settings.db.pool_min_size
+    assert data["pool"]["pool_size"] >= data["pool"]["pool_min"]
+    assert isinstance(data["counters"], dict)
+
+
+def test_metrics(client):
+    client.get("/api/stats")
+    response = client.get("/metrics")
+    assert response.status_code == HTTPStatus.OK
+    assert response.headers["content-type"].startswith("text/plain")
+    assert 'route="/api/stats"' in response.text
+    assert "blackledger_request_duration_seconds_bucket" in response.text
+    assert 'blackledger_pool_size{pool="primary"}' in response.text
+
+
+def test_request_metrics_streaming():
+    """
+    The request latency is observed when the response has been sent completely,
+    including the body of a streaming response.
+    """
+    stream_app = FastAPI()
+    stream_app.add_middleware(RequestMetricsMiddleware)
+
+    @stream_app.get("/test/stream/{delay}")
+    async def stream(delay: float):
+        async def body():
+            yield b"first\n"
+            await asyncio.sleep(delay)
+            yield b"last\n"
+
+        return StreamingResponse(body(), media_type="text/plain")
+
+    labels = {"method": "GET", "route": "/test/stream/{delay}", "status": "200"}
+
+    def sample(name):
+        value = prometheus_client.REGISTRY.get_sample_value(
+            f"blackledger_request_duration_seconds_{name}", labels
+        )
+        return value or 0
+
+    count, total = sample("count"), sample("sum")
+    with TestClient(stream_app) as client:
+        response = client.get("/test/stream/0.2")
+    assert response.text == "first\nlast\n"
+    assert sample("count") == count + 1
+    assert sample("sum") - total >= 0.2
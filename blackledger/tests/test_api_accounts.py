@@ -1,9 +1,14 @@
+import csv
+import io
+import json
 import logging
+from decimal import Decimal
 from http import HTTPStatus
 
 import pytest
 
 from blackledger import model, types
+from blackledger.search import encode_cursor
 
 LOG = logging.getLogger(__name__)
 
@@ -76,6 +81,15 @@ def testsearch_accounts(client, base_accounts, query, expected_names):
     assert response_names == expected_names
 
 
+def testsearch_accounts_fields(client, base_accounts):
+    """
+    The search results have exactly the fields of the response model.
+    """
+    response = client.get(f"/api/accounts?id={base_accounts['Asset'].id}")
+    assert response.status_code == HTTPStatus.OK
+    assert [set(item) for item in response.json()] == [set(model.Account.model_fields)]
+
+
 def testsearch_accounts_unmatched_ledger(client, base_accounts):
     response = client.get(f"/api/accounts?ledger={types.new_bigid()}")
     print(f"{response.json()=}")
@@ -187,3 +201,94 @@ def test_update_account_conflict(client, json_dumps, base_accounts, name, update
 def test_create_account_invalid(client, json_dumps, base_accounts, item):
     response = client.post("/api/accounts", content=json_dumps(item))
     assert response.status_code == HTTPStatus.UNPROCESSABLE_ENTITY
+
+
+# -- EXPORT ACCOUNT --
+
+
+def test_export_account_ndjson(client, test_accounts, test_transactions):
+    """
+    The account export has one line per transaction in the account, in transaction
+    order, with the account's entries in the transaction.
+    """
+    acct = test_accounts["Equity"].id
+    response = client.get(f"/api/accounts/{acct}/export")
+    assert response.status_code == HTTPStatus.OK
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    transactions = [json.loads(line) for line in response.text.splitlines()]
+    assert [tx["memo"] for tx in transactions] == [
+        "lunch",
+        "dinner",
+        "5 MSFT @ 377.43 USD",
+    ]
+    assert [len(tx["entries"]) for tx in transactions] == [2, 2, 2]
+    assert all(e["acct"] == acct for tx in transactions for e in tx["entries"])
+
+
+def test_export_account_csv(client, test_accounts, test_transactions):
+    """
+    The account CSV export has a header row and one row per entry in the account.
+    """
+    acct = test_accounts["Expense"].id
+    response = client.get(f"/api/accounts/{acct}/export?_format=csv")
+    assert response.status_code == HTTPStatus.OK
+    assert response.headers["content-type"].startswith("text/csv")
+    rows = list(csv.DictReader(io.StringIO(response.text)))
+    assert [(row["memo"], row["dr"], row["curr"]) for row in rows] == [
+        ("lunch", "20", "CAD"),
+        ("dinner", "28", "CAD"),
+    ]
+
+
+def test_export_account_not_found(client):
+    response = client.get(f"/api/accounts/{types.new_bigid()}/export")
+    assert response.status_code == HTTPStatus.NOT_FOUND
+
+
+def test_account_register(client, test_accounts, test_transactions):
+    """
+    The account register lists the account's entries in effective order with the
+    running balance in each currency, and the balances are the same on every page.
+    """
+
+    def register(response):
+        assert response.status_code == HTTPStatus.OK
+        return [(e["memo"], e["curr"], Decimal(e["balance"])) for e in response.json()]
+
+    acct = test_accounts["Asset"].id
+    expected = [
+        ("client1", "USD", Decimal("1000")),
+        ("client2", "USD", Decimal("2500")),
+        ("lunch", "USD", Decimal("2485")),
+        ("dinner", "USD", Decimal("2464")),
+        ("5 MSFT @ 377.43 USD", "MSFT", Decimal("5")),
+        ("5 MSFT @ 377.43 USD", "USD", Decimal("577")),
+    ]
+    assert register(client.get(f"/api/accounts/{acct}/register")) == expected
+
+    url, responses = f"/api/accounts/{acct}/register?_limit=2", []
+    while url:
+        responses.append(client.get(url))
+        url = responses[-1].links.get("next", {}).get("url")
+    assert [e for response in responses for e in register(response)] == expected
+
+    # the previous page of the last page (of 2)
+    prev_url = responses[2].links["prev"]["url"]
+    assert register(client.get(prev_url)) == expected[2:4]
+
+    response = client.get(f"/api/accounts/{acct}/register?curr=MSFT")
+    assert register(response) == expected[4:5]
+
+
+def test_account_register_not_found(client):
+    response = client.get(f"/api/accounts/{types.new_bigid()}/register")
+    assert response.status_code == HTTPStatus.NOT_FOUND
+
+
+@pytest.mark.parametrize("cursor", [["not a time", 1], ["2001-01-01T00:00:00Z", "1"]])
+def test_account_register_cursor_invalid(client, test_accounts, cursor):
+    response = client.get(
+        f"/api/accounts/{test_accounts['Asset'].id}/register",
+        params={"_after": encode_cursor(cursor)},
+    )
+    assert response.status_code == HTTPStatus.UNPROCESSABLE_ENTITY
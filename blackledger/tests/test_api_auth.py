@@ -1,8 +1,14 @@
+import time
 from http import HTTPStatus
 from unittest.mock import MagicMock, patch
 
+import jwt
+import pytest
 
-class MockPyJWKClient(MagicMock):
+from blackledger.auth import SigningKeyCache, TokenCache
+
+
+class MockSigningKeyCache(MagicMock):
     get_signing_key_from_jwt = MagicMock()
 
 
@@ -11,8 +17,88 @@ def test_home_auth_unauthorized(auth_client):
     assert response.status_code == HTTPStatus.UNAUTHORIZED
 
 
-@patch("blackledger.api.router.jwt_authorization_dependency.client", MockPyJWKClient())
+@patch(
+    "blackledger.api.router.jwt_authorization_dependency.signing_keys",
+    MockSigningKeyCache(),
+)
 @patch("jwt.decode", MagicMock(return_value={}))
 def test_home_auth_authorized(auth_client):
     response = auth_client.get("/api", headers={"Authorization": "CAN_HAZ"})
     assert response.status_code == HTTPStatus.OK
+
+
+@patch(
+    "blackledger.api.router.jwt_authorization_dependency.signing_keys",
+    MockSigningKeyCache(),
+)
+def test_home_auth_token_cached(auth_client):
+    """
+    A verified token is cached until it expires, so it is only decoded once.
+    """
+    decode = MagicMock(return_value={"sub": "cached", "exp": time.time() + 60})
+    with patch("jwt.decode", decode):
+        for _ in range(3):
+            response = auth_client.get(
+                "/api", headers={"Authorization": f"Bearer CACHED-{time.time()}-0"}
+            )
+            assert response.status_code == HTTPStatus.OK
+        assert decode.call_count == 3
+
+        headers = {"Authorization": f"Bearer CACHED-{time.time()}-1"}
+        for _ in range(3):
+            response = auth_client.get("/api", headers=headers)
+            assert response.status_code == HTTPStatus.OK
+        assert decode.call_count == 4
+
+
+def test_token_cache():
+    cache = TokenCache(maxsize=2)
+    cache.set("a", {"exp": time.time() + 60})
+    cache.set("b", {"exp": time.time() + 60})
+    assert cache.get("a") is not None
+    cache.set("c", {"exp": time.time() + 60})  # evicts the least recently used, "b"
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+    assert cache.get("c") is not None
+
+    # expired and non-expiring tokens are not returned
+    cache.set("d", {"exp": time.time() - 1})
+    assert cache.get("d") is None
+    cache.set("e", {})
+    assert cache.get("e") is None
+
+
+def test_signing_key_cache():
+    """
+    Signing keys are fetched again after their lifespan, and a rotated-out key is no
+    longer trusted; stale keys are used while fetching fails; unknown kids fetch the
+    keys at most once per refresh interval.
+    """
+    client = MagicMock()
+    client.get_signing_keys.return_value = [MagicMock(key_id="a")]
+    keys = SigningKeyCache(client, lifespan=60, refresh_interval=10)
+    with patch("time.monotonic", return_value=1000):
+        assert keys.get_signing_key("a").key_id == "a"
+        assert keys.get_signing_key("a").key_id == "a"
+        assert client.get_signing_keys.call_count == 1
+
+        # unknown kids are rate-limited
+        for _ in range(3):
+            with pytest.raises(jwt.PyJWKClientError):
+                keys.get_signing_key("random")
+        assert client.get_signing_keys.call_count == 1
+
+    # after the lifespan, stale keys are used while fetching fails
+    client.get_signing_keys.side_effect = jwt.PyJWKClientConnectionError("down")
+    with patch("time.monotonic", return_value=1060):
+        assert keys.get_signing_key("a").key_id == "a"
+        assert client.get_signing_keys.call_count == 2
+
+    # once a fetch succeeds, a key that has been rotated out is not trusted
+    client.get_signing_keys.side_effect = None
+    client.get_signing_keys.return_value = [MagicMock(key_id="b")]
+    with patch("time.monotonic", return_value=1070):
+        assert keys.get_signing_key("b").key_id == "b"
+        with pytest.raises(jwt.PyJWKClientError):
+            keys.get_signing_key("a")
+        assert client.get_signing_keys.call_count == 3
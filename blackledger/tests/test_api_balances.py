@@ -57,3 +57,216 @@ def test_get_balances_filters_ok(client, test_transactions, query, keys):
         item["account"]["name"].split("-")[0] for item in response.json()
     }
     assert response_account_keys == keys
+
+
+def test_get_balances_after_post(client, base_ledger, test_accounts, json_dumps):
+    """
+    Posting a transaction updates the balances of its accounts in the same database
+    transaction, for every currency in the transaction.
+    """
+    asset_id, equity_id = test_accounts["Asset"].id, test_accounts["Equity"].id
+    post_tx = {
+        "memo": "balances",
+        "ledger_id": base_ledger.id,
+        "entries": [
+            {"acct": asset_id, "dr": "100.50", "curr": "USD"},
+            {"acct": equity_id, "cr": "100.50", "curr": "USD"},
+            {"acct": asset_id, "dr": "7", "curr": "CAD"},
+            {"acct": equity_id, "cr": "7", "curr": "CAD"},
+        ],
+    }
+    for _ in range(2):
+        response = client.post("/api/transactions", content=json_dumps(post_tx))
+        assert response.status_code == HTTPStatus.CREATED
+
+    response = client.get(f"/api/accounts/balances?id={asset_id},{equity_id}")
+    assert response.status_code == HTTPStatus.OK
+    balances = {item["account"]["id"]: item["balances"] for item in response.json()}
+    assert balances == {
+        asset_id: {"USD": "201.00", "CAD": "14"},
+        equity_id: {"USD": "201.00", "CAD": "14"},
+    }
+
+
+def test_get_balances_as_of(client, dbpool, base_ledger, test_accounts, json_dumps):
+    """
+    Balances as_of a given time include only the transactions effective at or before
+    that time, whether or not there is a balance snapshot before that time, and
+    snapshots include transactions that are posted later with an earlier effective time
+    (including those in a currency that the snapshot didn't have).
+    """
+    asset_id, income_id = test_accounts["Asset"].id, test_accounts["Income"].id
+
+    def post(amount, effective, curr="USD"):
+        post_tx = {
+            "ledger_id": base_ledger.id,
+            "effective": effective,
+            "entries": [
+                {"acct": asset_id, "dr": amount, "curr": curr},
+                {"acct": income_id, "cr": amount, "curr": curr},
+            ],
+        }
+        response = client.post("/api/transactions", content=json_dumps(post_tx))
+        assert response.status_code == HTTPStatus.CREATED
+
+    def get_asset_balance(as_of):
+        response = client.get(f"/api/accounts/balances?id={asset_id}&as_of={as_of}")
+        assert response.status_code == HTTPStatus.OK
+        return {
+            curr: amount
+            for item in response.json()
+            for curr, amount in item["balances"].items()
+        }
+
+    post("100", "2001-01-15T00:00:00Z")
+    post("20", "2001-02-15T00:00:00Z")
+    assert get_asset_balance("2001-01-01T00:00:00Z") == {}
+    assert get_asset_balance("2001-01-31T00:00:00Z") == {"USD": "100"}
+    assert get_asset_balance("2001-03-01T00:00:00Z") == {"USD": "120"}
+
+    with dbpool.connection() as conn:
+        conn.execute(
+            "SELECT account_balance_snapshot_build(%s)", ["2001-02-01T00:00:00Z"]
+        )
+    assert get_asset_balance("2001-02-01T00:00:00Z") == {"USD": "100"}
+    assert get_asset_balance("2001-03-01T00:00:00Z") == {"USD": "120"}
+
+    # back-dated transaction is included in the snapshot
+    post("3", "2001-01-20T00:00:00Z")
+    assert get_asset_balance("2001-01-31T00:00:00Z") == {"USD": "103"}
+    assert get_asset_balance("2001-02-01T00:00:00Z") == {"USD": "103"}
+    assert get_asset_balance("2001-03-01T00:00:00Z") == {"USD": "123"}
+
+    post("5", "2001-01-25T00:00:00Z", curr="CAD")
+    assert get_asset_balance("2001-01-31T00:00:00Z") == {"USD": "103", "CAD": "5"}
+    assert get_asset_balance("2001-03-01T00:00:00Z") == {"USD": "123", "CAD": "5"}
+
+
+# -- GET ROLLUP BALANCES --
+
+
+def test_get_rollup_balances(client, base_ledger, test_accounts, run_id, json_dumps):
+    """
+    The rolled-up balances of an account include the balances of all of its descendant
+    accounts, including those that are moved under it after they have balances.
+    """
+    accts = test_accounts
+    response = client.post(
+        "/api/accounts",
+        content=json_dumps(
+            {"ledger_id": base_ledger.id, "name": f"Parent-{run_id}", "normal": "DR"}
+        ),
+    )
+    assert response.status_code == HTTPStatus.OK
+    parent = response.json()
+
+    # Expense is under Asset, which is under Parent
+    for name, parent_id in [("Asset", parent["id"]), ("Expense", accts["Asset"].id)]:
+        data = accts[name].model_dump(exclude_none=True) | {"parent_id": parent_id}
+        response = client.post("/api/accounts", content=json_dumps(data))
+        assert response.status_code == HTTPStatus.OK
+
+    post_tx = {
+        "ledger_id": base_ledger.id,
+        "entries": [
+            {"acct": accts["Asset"].id, "dr": "100", "curr": "USD"},
+            {"acct": accts["Income"].id, "cr": "100", "curr": "USD"},
+            {"acct": accts["Expense"].id, "dr": "30", "curr": "USD"},
+            {"acct": accts["Asset"].id, "cr": "30", "curr": "USD"},
+            {"acct": accts["Expense"].id, "dr": "5", "curr": "CAD"},
+            {"acct": accts["Equity"].id, "cr": "5", "curr": "CAD"},
+        ],
+    }
+    response = client.post("/api/transactions", content=json_dumps(post_tx))
+    assert response.status_code == HTTPStatus.CREATED
+
+    ids = [parent["id"], accts["Asset"].id, accts["Expense"].id, accts["Income"].id]
+    response = client.get(f"/api/accounts/balances/rollup?id={','.join(map(str, ids))}")
+    assert response.status_code == HTTPStatus.OK
+    balances = {item["account"]["id"]: item["balances"] for item in response.json()}
+    assert balances == {
+        parent["id"]: {"USD": "100", "CAD": "5"},
+        accts["Asset"].id: {"USD": "100", "CAD": "5"},
+        accts["Expense"].id: {"USD": "30", "CAD": "5"},
+        accts["Income"].id: {"USD": "100"},
+    }
+
+    # moving Expense back to the top level removes it from the rollups
+    data = accts["Expense"].model_dump(exclude_none=True) | {"parent_id": None}
+    response = client.post("/api/accounts", content=json_dumps(data))
+    assert response.status_code == HTTPStatus.OK
+    response = client.get(f"/api/accounts/balances/rollup?id={parent['id']}")
+    assert response.json()[0]["balances"] == {"USD": "70"}
+
+
+def test_account_parent_cycle_conflict(client, test_accounts, json_dumps):
+    """
+    An account cannot be moved under itself or one of its descendants.
+    """
+    asset, expense = test_accounts["Asset"], test_accounts["Expense"]
+    data = expense.model_dump(exclude_none=True) | {"parent_id": asset.id}
+    response = client.post("/api/accounts", content=json_dumps(data))
+    assert response.status_code == HTTPStatus.OK
+
+    for acct, parent_id in [(asset, asset.id), (asset, expense.id)]:
+        data = acct.model_dump(exclude_none=True) | {"parent_id": parent_id}
+        response = client.post("/api/accounts", content=json_dumps(data))
+        assert response.status_code == HTTPStatus.CONFLICT
+
+
+# -- SHARDED (HOT) ACCOUNTS --
+
+
+def test_sharded_account_balances(
+    client, dbpool, base_ledger, test_accounts, run_id, json_dumps
+):
+    """
+    The balance of a sharded account is the sum of its shards. Sharded accounts are not
+    versioned, so entries for them can't have an account_version.
+    """
+    response = client.post(
+        "/api/accounts",
+        content=json_dumps(
+            {
+                "ledger_id": base_ledger.id,
+                "name": f"Fees-{run_id}",
+                "normal": "CR",
+                "shards": 4,
+            }
+        ),
+    )
+    assert response.status_code == HTTPStatus.OK
+    fees = response.json()
+    assert fees["shards"] == 4
+
+    asset_id = test_accounts["Asset"].id
+    post_tx = {
+        "ledger_id": base_ledger.id,
+        "entries": [
+            {"acct": asset_id, "dr": "2", "curr": "USD"},
+            {"acct": fees["id"], "cr": "2", "curr": "USD"},
+        ],
+    }
+    for _ in range(3):
+        response = client.post("/api/transactions", content=json_dumps(post_tx))
+        assert response.status_code == HTTPStatus.CREATED
+
+    # move the balance rows out of the way, so that the next post adds another shard
+    with dbpool.connection() as conn:
+        conn.execute(
+            "UPDATE account_balance SET shard = shard + 4 WHERE acct = %s",
+            [fees["id"]],
+        )
+    response = client.post("/api/transactions", content=json_dumps(post_tx))
+    assert response.status_code == HTTPStatus.CREATED
+
+    response = client.get(f"/api/accounts/balances?id={fees['id']},{asset_id}")
+    balances = {item["account"]["id"]: item for item in response.json()}
+    assert balances[fees["id"]]["balances"] == {"USD": "8"}
+    assert balances[fees["id"]]["account"]["version"] is None
+    assert balances[asset_id]["balances"] == {"USD": "8"}
+    assert balances[asset_id]["account"]["version"] is not None
+
+    post_tx["entries"][1]["version"] = types.new_bigid()
+    response = client.post("/api/transactions", content=json_dumps(post_tx))
+    assert response.status_code == HTTPStatus.PRECONDITION_FAILED
@@ -76,3 +76,22 @@ def test_post_ledger_insert_unprocessable(client, data, json_dumps):
     response = client.post("/api/ledgers", content=json_dumps(data))
     print(response.json())
     assert response.status_code == HTTPStatus.UNPROCESSABLE_ENTITY
+
+
+def test_export_ledger(client, base_ledger, test_transactions):
+    """
+    The ledger export includes every transaction in the ledger, in transaction order.
+    """
+    response = client.get(f"/api/ledgers/{base_ledger.id}/export")
+    assert response.status_code == HTTPStatus.OK
+    transactions = [json.loads(line) for line in response.text.splitlines()]
+    tx_ids = [tx["id"] for tx in transactions]
+    assert tx_ids == sorted(tx_ids)
+    exported = {tx["id"]: tx for tx in transactions}
+    for test_tx in test_transactions:
+        assert len(exported[test_tx["id"]]["entries"]) == len(test_tx["entries"])
+
+
+def test_export_ledger_not_found(client):
+    response = client.get(f"/api/ledgers/{types.new_bigid()}/export")
+    assert response.status_code == HTTPStatus.NOT_FOUND
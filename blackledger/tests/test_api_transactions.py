@@ -1,9 +1,18 @@
+import json
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from http import HTTPStatus
+from unittest.mock import patch
 
 import pytest
+from fastapi.testclient import TestClient
+from psycopg.errors import DeadlockDetected
 
-from blackledger import types
+from blackledger import posting, types
+from blackledger.db import pool, queries
+from blackledger.http import app
+from blackledger.metrics import COUNTERS
+from blackledger.search import encode_cursor
 
 LOG = logging.getLogger(__name__)
 
@@ -23,6 +32,20 @@ LOG = logging.getLogger(__name__)
             ["5 MSFT @ 377.43 USD"],
         ),
         (f"?ledger={types.new_bigid()}", []),
+        (
+            "?_orderby=id&min_amount=1000",
+            ["client1", "client2", "5 MSFT @ 377.43 USD"],
+        ),
+        (
+            "?_orderby=id&max_amount=20",
+            ["lunch", "5 MSFT @ 377.43 USD"],
+        ),
+        (
+            "?_orderby=id&min_amount=15&max_amount=20&curr=USD",
+            ["lunch"],
+        ),
+        ("?effective_to=2000-01-01", []),
+        ("?posted_from=2999-01-01", []),
         # -- SELECT PARAMS --
         # orderby
         (
@@ -68,6 +91,112 @@ def testsearch_transactions(client, test_transactions, query, memos):
         assert len(response_tx["entries"]) == len(test_tx["entries"])
 
 
+@pytest.mark.parametrize("orderby", ["id", "-id"])
+def test_search_transactions_cursor(client, test_transactions, orderby):
+    """
+    Following the "next" cursor links pages through all the transactions in order, and
+    following the "prev" cursor links pages back through them.
+    """
+    test_transaction_ids = [t["id"] for t in test_transactions]
+    memos = [t["memo"] for t in test_transactions]
+    if orderby.startswith("-"):
+        memos.reverse()
+
+    url = (
+        f"/api/transactions?_orderby={orderby}&_limit=2"
+        f"&tx={','.join(str(t) for t in test_transaction_ids)}"
+    )
+    pages = []
+    while url:
+        response = client.get(url)
+        assert response.status_code == HTTPStatus.OK
+        pages.append([t["memo"] for t in response.json()])
+        url = response.links.get("next", {}).get("url")
+    assert [memo for page in pages for memo in page] == memos
+    assert [len(page) for page in pages] == [2, 2, 1]
+
+    url = response.links.get("prev", {}).get("url")
+    prev_pages = [pages[-1]]
+    while url:
+        response = client.get(url)
+        assert response.status_code == HTTPStatus.OK
+        prev_pages.insert(0, [t["memo"] for t in response.json()])
+        url = response.links.get("prev", {}).get("url")
+    assert [memo for page in prev_pages for memo in page] == memos
+
+
+def test_search_transactions_cursor_first_page(client, test_transactions):
+    """
+    The first page (requested without a cursor, with or without an offset) has a "next"
+    link but no "prev" link.
+    """
+    tx = ",".join(str(t["id"]) for t in test_transactions)
+    for query in ["_orderby=id&_limit=2", "_orderby=id&_limit=2&_offset=1"]:
+        response = client.get(f"/api/transactions?{query}&tx={tx}")
+        assert response.status_code == HTTPStatus.OK
+        assert "next" in response.links
+        assert "prev" not in response.links
+
+
+def test_search_transactions_cursor_invalid(client):
+    """
+    Cursors require ordering by the cursor key and must be valid cursor tokens, with a
+    value of the cursor key's type.
+    """
+    for query in [
+        "?_orderby=memo&_after=MQ",
+        "?_after=!!",
+        "?_after=MQ&_before=MQ",
+        f"?_after={encode_cursor('x')}",
+        f"?_before={encode_cursor({'id': 1})}",
+    ]:
+        response = client.get(f"/api/transactions{query}")
+        assert response.status_code == HTTPStatus.UNPROCESSABLE_ENTITY
+
+
+def test_search_transactions_meta(client, base_ledger, test_accounts):
+    """
+    The meta.KEY=VALUE params list the transactions whose meta contains the values.
+    """
+    invoice_id = f"INV-{types.new_bigid()}"
+    for meta in [
+        {"invoice_id": invoice_id, "customer": {"id": 1}},
+        {"invoice_id": invoice_id, "customer": {"id": 2}},
+    ]:
+        response = client.post(
+            "/api/transactions",
+            json={
+                "ledger_id": base_ledger.id,
+                "memo": f"invoice {invoice_id}",
+                "meta": meta,
+                "entries": [
+                    {"acct": test_accounts["Asset"].id, "dr": "10", "curr": "USD"},
+                    {"acct": test_accounts["Income"].id, "cr": "10", "curr": "USD"},
+                ],
+            },
+        )
+        assert response.status_code == HTTPStatus.CREATED
+
+    for query, customer_ids in [
+        (f"meta.invoice_id={invoice_id}", [1, 2]),
+        (f"meta.invoice_id={invoice_id}&meta.customer.id=2", [2]),
+        (f"meta.invoice_id={invoice_id}&meta.customer.id=%222%22", []),
+        # a later value for the same key replaces the earlier one
+        (f"meta.invoice_id=other&meta.invoice_id={invoice_id}", [1, 2]),
+        (f"meta.invoice_id={invoice_id}&meta.invoice_id=other", []),
+        (f"meta.invoice_id={invoice_id}&meta.customer={{}}&meta.customer.id=1", [1]),
+        (f"memo={invoice_id}$", [1, 2]),
+    ]:
+        response = client.get(f"/api/transactions?_orderby=id&{query}")
+        assert response.status_code == HTTPStatus.OK
+        assert [t["meta"]["customer"]["id"] for t in response.json()] == customer_ids
+
+    # a key can't be both a value and an object of nested keys, in either order
+    for query in ["meta.invoice_id=1&meta.invoice_id.x=2", "meta.a.x=2&meta.a=1"]:
+        response = client.get(f"/api/transactions?{query}")
+        assert response.status_code == HTTPStatus.UNPROCESSABLE_ENTITY
+
+
 # -- POST TRANSACTION --
 
 
@@ -212,6 +341,37 @@ def test_post_transaction_not_found(
     assert response.status_code == HTTPStatus.NOT_FOUND
 
 
+def test_post_transaction_account_other_ledger(
+    client, base_ledger, test_accounts, run_id, json_dumps
+):
+    """
+    An entry can only post to an account in the transaction's ledger: Posting to an
+    account in another ledger is a conflict (409).
+    """
+    response = client.post(
+        "/api/ledgers", content=json_dumps({"name": f"Other Ledger {run_id}"})
+    )
+    other_ledger_id = response.json()["id"]
+    response = client.post(
+        "/api/accounts",
+        content=json_dumps(
+            {"ledger_id": other_ledger_id, "name": f"Other {run_id}", "normal": "DR"}
+        ),
+    )
+    other_acct_id = response.json()["id"]
+
+    post_tx = {
+        "memo": "tx with an account in another ledger",
+        "ledger_id": base_ledger.id,
+        "entries": [
+            {"acct": other_acct_id, "dr": "1000", "curr": "USD"},
+            {"acct": test_accounts["Income"].id, "cr": "1000", "curr": "USD"},
+        ],
+    }
+    response = client.post("/api/transactions", content=json_dumps(post_tx))
+    assert response.status_code == HTTPStatus.CONFLICT
+
+
 @pytest.mark.parametrize(
     "version, status_code",
     [
@@ -334,3 +494,674 @@ def test_post_transaction_precondition_failed(
     ]:
         response = client.post("/api/transactions", content=json_dumps(post_tx))
         assert response.status_code == HTTPStatus.UNPROCESSABLE_ENTITY
+
+
+def test_post_transaction_multiple_entries_per_account(
+    client, base_ledger, test_accounts, test_transactions, json_dumps
+):
+    """
+    When a transaction has several entries for the same account, all the entries are
+    posted, and the account version becomes the id of the last entry for the account.
+    Only the first entry for each account needs a valid version.
+    """
+    accounts = client.get(
+        f"/api/accounts?id={test_accounts['Asset'].id},{test_accounts['Equity'].id}"
+    ).json()
+    versions = {account["id"]: account["version"] for account in accounts}
+    asset_id, equity_id = test_accounts["Asset"].id, test_accounts["Equity"].id
+    post_tx = {
+        "memo": "multi-leg tx",
+        "ledger_id": base_ledger.id,
+        "entries": [
+            {"acct": asset_id, "version": versions[asset_id], "dr": 10, "curr": "USD"},
+            {"acct": equity_id, "cr": 10, "curr": "USD"},
+            {"acct": asset_id, "dr": 20, "curr": "CAD"},
+            {"acct": equity_id, "version": types.new_bigid(), "cr": 20, "curr": "CAD"},
+        ],
+    }
+    response = client.post("/api/transactions", content=json_dumps(post_tx))
+    assert response.status_code == HTTPStatus.CREATED
+    response_tx = response.json()
+    assert len(response_tx["entries"]) == 4
+
+    expected_versions = {entry["acct"]: entry["id"] for entry in response_tx["entries"]}
+    accounts = client.get(f"/api/accounts?id={asset_id},{equity_id}").json()
+    assert {account["id"]: account["version"] for account in accounts} == (
+        expected_versions
+    )
+
+
+# -- POST TRANSACTIONS BATCH --
+
+
+@pytest.mark.parametrize("query", ["", "?_chunk=1", "?_chunk=2"])
+def test_post_transactions_batch(client, base_ledger, test_accounts, json_dumps, query):
+    """
+    Each transaction in a batch is posted or rejected independently, and the response
+    has the result of each transaction in the order given.
+    """
+    asset_id, income_id = test_accounts["Asset"].id, test_accounts["Income"].id
+
+    def new_tx(memo, dr_acct=asset_id, cr_acct=income_id, cr="100", curr="USD"):
+        return {
+            "memo": memo,
+            "ledger_id": base_ledger.id,
+            "entries": [
+                {"acct": dr_acct, "dr": "100", "curr": curr},
+                {"acct": cr_acct, "cr": cr, "curr": curr},
+            ],
+        }
+
+    batch = [
+        new_tx("ok 1"),
+        new_tx("unbalanced", cr="99"),
+        new_tx("unknown account", cr_acct=types.new_bigid()),
+        new_tx("unknown currency", curr="NOTACURRENCY"),
+        new_tx("ok 2"),
+    ]
+    response = client.post(f"/api/transactions/batch{query}", content=json_dumps(batch))
+    assert response.status_code == HTTPStatus.OK
+    results = response.json()
+    assert [result["index"] for result in results] == list(range(len(batch)))
+    assert [result["status"] for result in results] == [
+        HTTPStatus.CREATED,
+        HTTPStatus.UNPROCESSABLE_ENTITY,
+        HTTPStatus.NOT_FOUND,
+        HTTPStatus.CONFLICT,
+        HTTPStatus.CREATED,
+    ]
+
+    tx_ids = [result["id"] for result in results if result["id"]]
+    response = client.get(
+        f"/api/transactions?_orderby=id&tx={','.join(str(i) for i in tx_ids)}"
+    )
+    assert [tx["memo"] for tx in response.json()] == ["ok 1", "ok 2"]
+
+
+def test_post_transactions_batch_ndjson(client, base_ledger, test_accounts):
+    """
+    A batch can be posted as NDJSON: One transaction per line.
+    """
+    lines = [
+        json.dumps(
+            {
+                "memo": f"ndjson {i}",
+                "ledger_id": base_ledger.id,
+                "entries": [
+                    {"acct": test_accounts["Asset"].id, "dr": i, "curr": "USD"},
+                    {"acct": test_accounts["Income"].id, "cr": i, "curr": "USD"},
+                ],
+            }
+        )
+        for i in range(1, 4)
+    ]
+    response = client.post(
+        "/api/transactions/batch",
+        content="\n".join(lines),
+        headers={"Content-Type": "application/x-ndjson"},
+    )
+    assert response.status_code == HTTPStatus.OK
+    assert [result["status"] for result in response.json()] == [HTTPStatus.CREATED] * 3
+
+
+@pytest.mark.parametrize("content", ["not json", '{"memo": "not a list"}'])
+def test_post_transactions_batch_invalid(client, content):
+    """
+    A batch that is not a list of transactions is rejected as a whole.
+    """
+    response = client.post("/api/transactions/batch", content=content)
+    assert response.status_code == HTTPStatus.UNPROCESSABLE_ENTITY
+
+
+@pytest.mark.parametrize("query", ["", "?_chunk=1"])
+def test_post_transactions_batch_versions(
+    client, base_ledger, test_accounts, json_dumps, query
+):
+    """
+    The entry versions in a batch are checked against the accounts as they stand after
+    the earlier transactions in the batch: Two transactions that give the same version
+    for an account can't both be posted.
+    """
+    asset_id, income_id = test_accounts["Asset"].id, test_accounts["Income"].id
+    client.post(
+        "/api/transactions/batch",
+        content=json_dumps(
+            [
+                {
+                    "ledger_id": base_ledger.id,
+                    "entries": [
+                        {"acct": asset_id, "dr": "1", "curr": "USD"},
+                        {"acct": income_id, "cr": "1", "curr": "USD"},
+                    ],
+                }
+            ]
+        ),
+    )
+    version = client.get(f"/api/accounts?id={asset_id}").json()[0]["version"]
+
+    new_tx = {
+        "ledger_id": base_ledger.id,
+        "entries": [
+            {"acct": asset_id, "dr": "1", "curr": "USD", "version": version},
+            {"acct": income_id, "cr": "1", "curr": "USD"},
+        ],
+    }
+    response = client.post(
+        f"/api/transactions/batch{query}", content=json_dumps([new_tx, new_tx])
+    )
+    assert response.status_code == HTTPStatus.OK
+    assert [result["status"] for result in response.json()] == [
+        HTTPStatus.CREATED,
+        HTTPStatus.PRECONDITION_FAILED,
+    ]
+
+
+# -- IDEMPOTENCY KEYS --
+
+
+def test_post_transaction_idempotency_key(
+    client, base_ledger, test_accounts, run_id, json_dumps
+):
+    """
+    Retrying a transaction with the same Idempotency-Key returns the original
+    transaction without posting it again.
+    """
+    post_tx = {
+        "memo": "idempotent",
+        "ledger_id": base_ledger.id,
+        "entries": [
+            {"acct": test_accounts["Asset"].id, "dr": "10", "curr": "USD"},
+            {"acct": test_accounts["Income"].id, "cr": "10", "curr": "USD"},
+        ],
+    }
+    headers = {"Idempotency-Key": f"idempotent-{run_id}"}
+    response = client.post(
+        "/api/transactions", content=json_dumps(post_tx), headers=headers
+    )
+    assert response.status_code == HTTPStatus.CREATED
+    original = response.json()
+    assert original["idempotency_key"] == headers["Idempotency-Key"]
+
+    response = client.post(
+        "/api/transactions", content=json_dumps(post_tx), headers=headers
+    )
+    assert response.status_code == HTTPStatus.OK
+    assert response.headers["Idempotent-Replayed"] == "true"
+    assert response.json()["id"] == original["id"]
+    assert [e["id"] for e in response.json()["entries"]] == [
+        e["id"] for e in original["entries"]
+    ]
+
+    response = client.get(f"/api/transactions?acct={test_accounts['Asset'].id}")
+    assert [tx["id"] for tx in response.json()] == [original["id"]]
+
+
+def test_post_transactions_batch_idempotency_key(
+    client, base_ledger, test_accounts, run_id, json_dumps
+):
+    """
+    Retrying a batch with idempotency keys does not post the transactions again, and a
+    key that is repeated in the batch is only posted once.
+    """
+    batch = [
+        {
+            "memo": f"batch idempotent {key}",
+            "ledger_id": base_ledger.id,
+            "idempotency_key": f"batch-{run_id}-{key}",
+            "entries": [
+                {"acct": test_accounts["Asset"].id, "dr": "10", "curr": "USD"},
+                {"acct": test_accounts["Income"].id, "cr": "10", "curr": "USD"},
+            ],
+        }
+        for key in [1, 2, 1]
+    ]
+    response = client.post("/api/transactions/batch", content=json_dumps(batch))
+    assert response.status_code == HTTPStatus.OK
+    results = response.json()
+    assert [r["status"] for r in results] == [
+        HTTPStatus.CREATED,
+        HTTPStatus.CREATED,
+        HTTPStatus.OK,
+    ]
+    assert results[2]["id"] == results[0]["id"]
+
+    response = client.post("/api/transactions/batch", content=json_dumps(batch))
+    assert response.status_code == HTTPStatus.OK
+    retried = response.json()
+    assert [r["status"] for r in retried] == [HTTPStatus.OK] * 3
+    assert [r["id"] for r in retried] == [r["id"] for r in results]
+
+    # a key that a concurrent request posts after the batch has looked up its keys is a
+    # replay of that transaction, not a conflict
+    select_transaction_ids_by_key = queries.select_transaction_ids_by_key
+    calls = []
+
+    async def posted_concurrently(*args, **kwargs):
+        calls.append(args)
+        if len(calls) == 1:
+            return {}
+        return await select_transaction_ids_by_key(*args, **kwargs)
+
+    with patch(
+        "blackledger.db.queries.select_transaction_ids_by_key", posted_concurrently
+    ):
+        response = client.post("/api/transactions/batch", content=json_dumps(batch))
+    assert response.status_code == HTTPStatus.OK
+    replayed = response.json()
+    assert [r["status"] for r in replayed] == [HTTPStatus.OK] * 3
+    assert [r["id"] for r in replayed] == [r["id"] for r in results]
+
+
+def test_post_transactions_batch_unavailable(
+    client, base_ledger, test_accounts, json_dumps
+):
+    """
+    If a chunk of the batch can't be committed, the earlier chunks stay committed, and
+    the results of the transactions in that chunk and the later ones are 503.
+    """
+    batch = [
+        {
+            "memo": f"batch unavailable {i}",
+            "ledger_id": base_ledger.id,
+            "entries": [
+                {"acct": test_accounts["Asset"].id, "dr": "10", "curr": "USD"},
+                {"acct": test_accounts["Income"].id, "cr": "10", "curr": "USD"},
+            ],
+        }
+        for i in range(3)
+    ]
+    post_transactions_chunk = posting.post_transactions_chunk
+    calls = []
+
+    async def deadlock_after_first(conn, sql, items):
+        calls.append(items)
+        if len(calls) > 1:
+            raise DeadlockDetected("deadlock detected")
+        return await post_transactions_chunk(conn, sql, items)
+
+    with patch("blackledger.posting.post_transactions_chunk", deadlock_after_first):
+        response = client.post(
+            "/api/transactions/batch?_chunk=1", content=json_dumps(batch)
+        )
+    assert response.status_code == HTTPStatus.OK
+    results = response.json()
+    assert [r["status"] for r in results] == [
+        HTTPStatus.CREATED,
+        HTTPStatus.SERVICE_UNAVAILABLE,
+        HTTPStatus.SERVICE_UNAVAILABLE,
+    ]
+    # the retries of the second chunk, and not the third chunk
+    assert len(calls) == 1 + app.settings.db.retry_attempts
+    response = client.get(f"/api/transactions?tx={results[0]['id']}")
+    assert len(response.json()) == 1
+
+
+# -- IMPORTS --
+
+
+def test_import_transactions_ndjson(client, base_ledger, test_accounts, run_id):
+    """
+    An NDJSON import imports the valid transactions, and has the result of each
+    transaction that wasn't imported, by index.
+    """
+    asset_id, income_id = test_accounts["Asset"].id, test_accounts["Income"].id
+
+    def new_tx(memo, cr_acct=income_id, cr="5", key=None):
+        return {
+            "memo": memo,
+            "ledger_id": base_ledger.id,
+            "idempotency_key": key,
+            "entries": [
+                {"acct": asset_id, "dr": "5", "curr": "USD"},
+                {"acct": cr_acct, "cr": cr, "curr": "USD"},
+            ],
+        }
+
+    lines = [
+        new_tx(f"import {run_id} 0", key=f"import-{run_id}"),
+        new_tx("import unbalanced", cr="4"),
+        new_tx("import unknown account", cr_acct=types.new_bigid()),
+        new_tx(f"import {run_id} 3"),
+        new_tx("import repeated", key=f"import-{run_id}"),
+    ]
+    response = client.post(
+        "/api/transactions/import",
+        content="\n".join(json.dumps(line) for line in lines),
+        headers={"Content-Type": "application/x-ndjson"},
+    )
+    assert response.status_code == HTTPStatus.OK
+    data = response.json()
+    assert data["imported"] == 2
+    assert [(r["index"], r["status"]) for r in data["results"]] == [
+        (1, HTTPStatus.UNPROCESSABLE_ENTITY),
+        (2, HTTPStatus.NOT_FOUND),
+        (4, HTTPStatus.OK),
+    ]
+
+    response = client.get(
+        "/api/transactions", params={"memo": f"^import {run_id} [0-9]$"}
+    )
+    assert sorted(tx["memo"] for tx in response.json()) == [
+        f"import {run_id} 0",
+        f"import {run_id} 3",
+    ]
+
+
+def test_import_transactions_csv(client, base_ledger, test_accounts, run_id):
+    """
+    A CSV import has one row per entry: Consecutive rows with the same tx are the
+    entries of one transaction.
+    """
+    asset_id, income_id = test_accounts["Asset"].id, test_accounts["Income"].id
+    rows = [
+        "tx,ledger_id,memo,meta,acct,curr,dr,cr",
+        f'1,{base_ledger.id},csv {run_id} 1,"{{""n"": 1}}",{asset_id},USD,7,',
+        f'1,{base_ledger.id},csv {run_id} 1,"{{""n"": 1}}",{income_id},USD,,7',
+        f"2,{base_ledger.id},csv {run_id} 2,,{asset_id},USD,8,",
+        f"2,{base_ledger.id},csv {run_id} 2,,{income_id},USD,,8",
+    ]
+    response = client.post(
+        "/api/transactions/import",
+        content="\n".join(rows),
+        headers={"Content-Type": "text/csv"},
+    )
+    assert response.status_code == HTTPStatus.OK
+    assert response.json() == {"imported": 2, "results": []}
+
+    response = client.get(
+        "/api/transactions", params={"memo": f"^csv {run_id}", "_orderby": "memo"}
+    )
+    transactions = response.json()
+    assert [tx["meta"] for tx in transactions] == [{"n": 1}, None]
+    assert [len(tx["entries"]) for tx in transactions] == [2, 2]
+
+
+@pytest.mark.parametrize(
+    "content, content_type",
+    [
+        (b"ledger_id,acct,curr,dr\n1,2,USD,1\n", "text/csv"),  # no tx column
+        (b"tx,ledger_id,acct,curr,dr\n,1,2,USD,1\n", "text/csv"),  # no tx
+        (b'{"memo": "\xff"}\n', "application/x-ndjson"),  # not UTF-8
+    ],
+)
+def test_import_transactions_invalid(client, content, content_type):
+    """
+    An import body that can't be read fails the whole import.
+    """
+    response = client.post(
+        "/api/transactions/import",
+        content=content,
+        headers={"Content-Type": content_type},
+    )
+    assert response.status_code == HTTPStatus.UNPROCESSABLE_ENTITY
+
+
+# -- DEADLOCK RETRIES --
+
+
+def test_post_transaction_deadlock_retried(
+    client, base_ledger, test_accounts, json_dumps
+):
+    """
+    A posting that is aborted by a deadlock is retried, and fails with 503 Service
+    Unavailable if it is aborted on every attempt.
+    """
+    post_tx = {
+        "ledger_id": base_ledger.id,
+        "entries": [
+            {"acct": test_accounts["Asset"].id, "dr": "1", "curr": "USD"},
+            {"acct": test_accounts["Income"].id, "cr": "1", "curr": "USD"},
+        ],
+    }
+    insert_transaction = queries.insert_transaction
+    calls = []
+
+    async def deadlock_once(*args, **kwargs):
+        calls.append(args)
+        if len(calls) == 1:
+            raise DeadlockDetected("deadlock detected")
+        return await insert_transaction(*args, **kwargs)
+
+    retried = COUNTERS["post_transaction.DeadlockDetected.retried"]
+    with patch("blackledger.db.queries.insert_transaction", deadlock_once):
+        response = client.post("/api/transactions", content=json_dumps(post_tx))
+    assert response.status_code == HTTPStatus.CREATED
+    assert len(calls) == 2
+    assert COUNTERS["post_transaction.DeadlockDetected.retried"] == retried + 1
+
+    async def deadlock_always(*args, **kwargs):
+        raise DeadlockDetected("deadlock detected")
+
+    with patch("blackledger.db.queries.insert_transaction", deadlock_always):
+        response = client.post("/api/transactions", content=json_dumps(post_tx))
+    assert response.status_code == HTTPStatus.SERVICE_UNAVAILABLE
+    assert response.headers["Retry-After"] == "1"
+
+
+# -- POSTING QUEUE --
+
+
+def test_post_transaction_posting_queue(base_ledger, test_accounts, run_id):
+    """
+    With the posting queue, concurrent postings are committed in groups, and each
+    request has the same result as if it had been posted alone.
+    """
+    accts = test_accounts
+
+    def post_tx(dr, cr, **kwargs):
+        return {
+            "ledger_id": base_ledger.id,
+            "entries": [
+                {"acct": dr, "dr": "1", "curr": "USD"},
+                {"acct": cr, "cr": "1", "curr": "USD"},
+            ],
+        } | kwargs
+
+    app.settings.auth.disabled = True
+    app.settings.db.posting_queue = True
+    try:
+        with TestClient(app) as client:
+            posts = [
+                post_tx(
+                    accts["Asset"].id, accts["Income"].id, idempotency_key=str(run_id)
+                ),
+                post_tx(
+                    accts["Asset"].id, accts["Income"].id, idempotency_key=str(run_id)
+                ),
+                post_tx(accts["Expense"].id, types.new_bigid()),
+            ] + [post_tx(accts["Expense"].id, accts["Liability"].id)] * 8
+            with ThreadPoolExecutor(max_workers=len(posts)) as executor:
+                responses = list(
+                    executor.map(
+                        lambda data: client.post("/api/transactions", json=data), posts
+                    )
+                )
+            stats = client.get("/api/stats").json()
+    finally:
+        app.settings.db.posting_queue = False
+
+    statuses = [response.status_code for response in responses]
+    assert sorted(statuses[:2]) == [HTTPStatus.OK, HTTPStatus.CREATED]
+    assert responses[0].json()["id"] == responses[1].json()["id"]
+    assert statuses[2] == HTTPStatus.NOT_FOUND
+    assert statuses[3:] == [HTTPStatus.CREATED] * 8
+    assert all(len(r.json()["entries"]) == 2 for r in responses if r.is_success)
+    assert stats["posting_queue"] == 0
+    assert stats["counters"]["posting_queue.groups"] >= 1
+
+
+def test_post_transaction_posting_queue_versions(base_ledger, test_accounts):
+    """
+    With the posting queue, each transaction's entry versions are checked against the
+    accounts as they stand after the earlier transactions in its group: Two concurrent
+    postings with the same version can't both be posted.
+    """
+    asset_id, income_id = test_accounts["Asset"].id, test_accounts["Income"].id
+
+    def post_tx(version=None):
+        return {
+            "ledger_id": base_ledger.id,
+            "entries": [
+                {"acct": asset_id, "dr": "1", "curr": "USD", "version": version},
+                {"acct": income_id, "cr": "1", "curr": "USD"},
+            ],
+        }
+
+    app.settings.auth.disabled = True
+    app.settings.db.posting_queue = True
+    app.settings.db.posting_group_delay = 0.1  # (so that the postings are grouped)
+    try:
+        with TestClient(app) as client:
+            client.post("/api/transactions", json=post_tx())
+            version = client.get(f"/api/accounts?id={asset_id}").json()[0]["version"]
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                responses = list(
+                    executor.map(
+                        lambda data: client.post("/api/transactions", json=data),
+                        [post_tx(version)] * 2,
+                    )
+                )
+    finally:
+        app.settings.db.posting_queue = False
+        app.settings.db.posting_group_delay = 0.0
+
+    assert sorted(response.status_code for response in responses) == [
+        HTTPStatus.CREATED,
+        HTTPStatus.PRECONDITION_FAILED,
+    ]
+
+
+def test_post_transaction_posting_queue_invalid_item(base_ledger, test_accounts):
+    """
+    With the posting queue, a transaction that the database rejects fails on its own:
+    The other transactions in its group are posted.
+    """
+    asset_id, income_id = test_accounts["Asset"].id, test_accounts["Income"].id
+
+    def post_tx(memo):
+        return {
+            "ledger_id": base_ledger.id,
+            "memo": memo,
+            "entries": [
+                {"acct": asset_id, "dr": "1", "curr": "USD"},
+                {"acct": income_id, "cr": "1", "curr": "USD"},
+            ],
+        }
+
+    posts = [post_tx("ok"), post_tx("NUL \x00"), post_tx("ok")]
+    app.settings.auth.disabled = True
+    app.settings.db.posting_queue = True
+    app.settings.db.posting_group_delay = 0.1  # (so that the postings are grouped)
+    try:
+        with TestClient(app) as client:
+            with ThreadPoolExecutor(max_workers=len(posts)) as executor:
+                responses = list(
+                    executor.map(
+                        lambda data: client.post("/api/transactions", json=data), posts
+                    )
+                )
+    finally:
+        app.settings.db.posting_queue = False
+        app.settings.db.posting_group_delay = 0.0
+
+    assert [response.status_code for response in responses] == [
+        HTTPStatus.CREATED,
+        HTTPStatus.UNPROCESSABLE_ENTITY,
+        HTTPStatus.CREATED,
+    ]
+
+
+# -- READ-YOUR-WRITES --
+
+
+def test_read_after_lsn_without_replica(client, base_ledger, test_accounts, json_dumps):
+    """
+    Without a read replica, reads use the primary, so the Read-After-LSN header isn't
+    needed (and is ignored), and postings don't return a Ledger-LSN.
+    """
+    post_tx = {
+        "ledger_id": base_ledger.id,
+        "entries": [
+            {"acct": test_accounts["Asset"].id, "dr": "1", "curr": "USD"},
+            {"acct": test_accounts["Income"].id, "cr": "1", "curr": "USD"},
+        ],
+    }
+    response = client.post("/api/transactions", content=json_dumps(post_tx))
+    assert response.status_code == HTTPStatus.CREATED
+    assert "Ledger-LSN" not in response.headers
+    tx_id = response.json()["id"]
+
+    response = client.get(
+        f"/api/transactions?tx={tx_id}", headers={"Read-After-LSN": "0/0"}
+    )
+    assert response.status_code == HTTPStatus.OK
+    assert [tx["id"] for tx in response.json()] == [tx_id]
+
+
+@pytest.mark.parametrize("posting_queue", [False, True])
+def test_read_after_lsn_with_replica(
+    dbpool, base_ledger, test_accounts, run_id, posting_queue
+):
+    """
+    With a read pool (here a second pool on the primary database), postings return the
+    Ledger-LSN of the primary once the transaction has been committed, and a read with
+    that Read-After-LSN uses the read pool once the replica has replayed it, or falls
+    back to the primary if it hasn't in time.
+    """
+    memo = f"read after lsn {run_id} {posting_queue}"
+    post_tx = {
+        "ledger_id": base_ledger.id,
+        "memo": memo,
+        "entries": [
+            {"acct": test_accounts["Asset"].id, "dr": "1", "curr": "USD"},
+            {"acct": test_accounts["Income"].id, "cr": "1", "curr": "USD"},
+        ],
+    }
+    current_lsn = pool.current_lsn
+    committed = []
+
+    async def committed_lsn(sql, conn):
+        # whether the transaction is visible to another connection when the LSN is read
+        with dbpool.connection() as other_conn:
+            committed.append(
+                other_conn.execute(
+                    "SELECT count(*) FROM transaction WHERE memo = %s", [memo]
+                ).fetchone()[0]
+            )
+        return await current_lsn(sql, conn)
+
+    async def not_replayed(*args):
+        return False
+
+    app.settings.auth.disabled = True
+    app.settings.db.read_url = app.settings.db.url
+    app.settings.db.posting_queue = posting_queue
+    try:
+        with TestClient(app) as client:
+            assert app.read_pool is not app.pool
+            with patch("blackledger.db.pool.current_lsn", committed_lsn):
+                with patch("blackledger.posting.current_lsn", committed_lsn):
+                    response = client.post("/api/transactions", json=post_tx)
+            assert response.status_code == HTTPStatus.CREATED
+            assert committed == [1]
+            lsn = response.headers["Ledger-LSN"]
+            assert pool.LSN_PATTERN.match(lsn)
+            tx_id = response.json()["id"]
+
+            # (the primary has no replay LSN, so it counts as replayed)
+            fallbacks = COUNTERS["read_pool.lsn_fallback"]
+            response = client.get(
+                f"/api/transactions?tx={tx_id}", headers={"Read-After-LSN": lsn}
+            )
+            assert [tx["id"] for tx in response.json()] == [tx_id]
+            assert COUNTERS["read_pool.lsn_fallback"] == fallbacks
+
+            with patch("blackledger.db.pool._wait_for_replay", not_replayed):
+                response = client.get(
+                    f"/api/transactions?tx={tx_id}", headers={"Read-After-LSN": lsn}
+                )
+            assert [tx["id"] for tx in response.json()] == [tx_id]
+            assert COUNTERS["read_pool.lsn_fallback"] == fallbacks + 1
+    finally:
+        app.settings.db.read_url = None
+        app.settings.db.posting_queue = False
@@ -19,6 +19,10 @@ NameFilter = Annotated[
 
 BigID: TypeAlias = int
 
+IdempotencyKey = Annotated[
+    str, Field(min_length=1, max_length=255, examples=["3f2b8c9e-payroll-2024-08"])
+]
+
 
 def new_bigid():
     return int(random() * 1_000)
@@ -36,3 +40,8 @@ class Normal(Enum):
             return 1
         elif self == self.CR:
             return -1
+
+
+class ExportFormat(Enum):
+    NDJSON = "ndjson"
+    CSV = "csv"
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+"""
+Benchmark the JSONResponse rendering of a transaction listing: the stdlib json encoder
+that JSONResponse used previously vs. the orjson-based JSONResponse.
+
+Usage: script/bench_json.py [--transactions N] [--number N]
+"""
+
+import argparse
+import json
+import timeit
+from datetime import datetime, timezone
+from decimal import Decimal
+
+from blackledger import model
+from blackledger.response import JSONResponse
+
+
+class JsonEncoder(json.JSONEncoder):
+    # the encoder that JSONResponse used with json.dumps
+    def default(self, obj):
+        if isinstance(obj, datetime):
+            return obj.isoformat()
+        elif isinstance(obj, Decimal):
+            return str(obj)
+        return super().default(obj)
+
+
+def stdlib_render(content):
+    return json.dumps(
+        content,
+        ensure_ascii=False,
+        allow_nan=False,
+        indent=None,
+        separators=(",", ":"),
+        cls=JsonEncoder,
+    ).encode("utf-8")
+
+
+def transactions(count: int) -> list[model.Transaction]:
+    now = datetime.now(tz=timezone.utc)
+    return [
+        model.Transaction(
+            id=i * 1000,
+            ledger_id=1000,
+            posted=now,
+            effective=now,
+            memo=f"transaction {i}",
+            meta={"invoice": f"INV-{i}"},
+            entries=[
+                model.Entry(
+                    id=i * 1000 + n,
+                    ledger_id=1000,
+                    tx=i * 1000,
+                    acct=2000 + n,
+                    acct_name=f"Account {n}",
+                    curr="USD",
+                    **{"dr" if n % 2 else "cr": Decimal("1234.56")},
+                )
+                for n in range(4)
+            ],
+        )
+        for i in range(count)
+    ]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n\n")[0])
+    parser.add_argument("--transactions", type=int, default=100)
+    parser.add_argument("--number", type=int, default=200)
+    args = parser.parse_args()
+
+    txs = transactions(args.transactions)
+    contents = {
+        # what the router passes to the response class after response_model
+        # serialization: strings for Decimal and datetime
+        "serialized": [tx.model_dump(mode="json") for tx in txs],
+        # python values, as when a handler returns a JSONResponse directly
+        "python": [tx.model_dump() for tx in txs],
+    }
+    response = JSONResponse(content=None)
+    for name, content in contents.items():
+        assert json.loads(stdlib_render(content)) == json.loads(
+            response.render(content)
+        )
+        for label, render in [("json", stdlib_render), ("orjson", response.render)]:
+            seconds = timeit.timeit(lambda: render(content), number=args.number)
+            print(f"{name:>10} {label:>6}: {seconds / args.number * 1e3:8.3f} ms")
@@ -0,0 +1,370 @@
+#!/usr/bin/env python
+"""
+Benchmark the ledger API against a local Postgres: posting throughput, balance query
+latency, transaction search and account register latency, and export speed, on a large
+synthetic ledger.
+
+The synthetic ledger is generated in the database (DATABASE_URL) with set-based queries,
+deterministically from the --accounts, --transactions and --currencies arguments, and is
+named after them, so that it is generated once and reused by later runs (an interrupted
+generation is resumed). Each transaction has two entries (a debit and a credit) in one
+currency, effective one minute after the previous transaction. The posting benchmarks
+post to a new ledger with the same number of accounts, so that the synthetic ledger is
+the same for every run. The requests are made to the app in-process (no network), with
+the requested accounts chosen by a seeded random generator, so that the results of runs
+on different commits are comparable. Requires httpx (in the test extras).
+
+Usage: script/bench_ledger.py [--accounts N] [--transactions N] [--currencies A,B,...]
+    [--requests N] [--concurrency N] [--output FILE] [--compare FILE]
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import subprocess
+import time
+from datetime import datetime, timezone
+
+import httpx
+import psycopg_pool
+from sqly import SQL
+
+from blackledger.http import app
+from blackledger.settings import DatabaseSettings
+
+GENERATE_BATCH = 100_000  # transactions inserted (and committed) per query
+
+GENERATE_TRANSACTIONS = """
+    WITH accts AS (
+        SELECT array_agg(id ORDER BY id) ids, count(*) n
+        FROM account WHERE ledger_id = :ledger_id
+    ), txs AS (
+        SELECT i, bigid() id
+        FROM generate_series(CAST(:first AS bigint), CAST(:last AS bigint)) i
+    ), tx AS (
+        INSERT INTO transaction (id, ledger_id, effective, memo, meta)
+        SELECT id, :ledger_id, CAST(:start AS timestamptz) + i * interval '1 minute',
+            'bench ' || i, jsonb_build_object('invoice_id', 'INV-' || i)
+        FROM txs
+    )
+    INSERT INTO entry (ledger_id, tx, effective, acct, curr, dr, cr)
+    SELECT :ledger_id, txs.id, CAST(:start AS timestamptz) + txs.i * interval '1 minute',
+        -- two different accounts
+        accts.ids[CAST(1 + CASE WHEN side.dr
+            THEN (txs.i * 31) % accts.n
+            ELSE ((txs.i * 31) % accts.n + 1 + txs.i % (accts.n - 1)) % accts.n
+        END AS integer)],
+        (CAST(:currencies AS varchar[]))[
+            CAST(1 + txs.i % cardinality(CAST(:currencies AS varchar[])) AS integer)
+        ],
+        CASE WHEN side.dr THEN CAST((txs.i * 7919) % 100000 + 1 AS decimal) / 100 END,
+        CASE WHEN NOT side.dr THEN CAST((txs.i * 7919) % 100000 + 1 AS decimal) / 100 END
+    FROM txs, accts, (VALUES (true), (false)) side (dr)
+"""
+
+
+def create_ledger(sql: SQL, conn, name: str, accounts: int, currencies) -> int:
+    """
+    Create a ledger with the given number of accounts, and return its id.
+    """
+    sql.execute(
+        conn,
+        "INSERT INTO currency (code) SELECT unnest(CAST(:currencies AS varchar[]))"
+        " ON CONFLICT (code) DO NOTHING",
+        {"currencies": currencies},
+    )
+    ledger_id = sql.select_one(
+        conn,
+        "INSERT INTO ledger (name) VALUES (:name) RETURNING id",
+        {"name": name},
+    )["id"]
+    sql.execute(
+        conn,
+        """
+        INSERT INTO account (ledger_id, name, normal)
+        SELECT :ledger_id, 'Account ' || i, CASE WHEN i % 2 = 0 THEN 'DR' ELSE 'CR' END
+        FROM generate_series(1, :accounts) i
+        """,
+        {"ledger_id": ledger_id, "accounts": accounts},
+    )
+    conn.commit()
+    return ledger_id
+
+
+def generate_ledger(sql: SQL, conn, accounts: int, transactions: int, currencies):
+    """
+    Return the id of the synthetic ledger for the given parameters, generating (the rest
+    of) its transactions if it doesn't have them all yet.
+    """
+    name = f"bench {accounts}x{transactions} {','.join(currencies)}"
+    ledger = sql.select_one(
+        conn,
+        """
+        SELECT id, (SELECT count(*) FROM transaction WHERE ledger_id = ledger.id) count
+        FROM ledger WHERE name = :name
+        """,
+        {"name": name},
+    )
+    if ledger:
+        ledger_id, count = ledger["id"], ledger["count"]
+    else:
+        ledger_id, count = create_ledger(sql, conn, name, accounts, currencies), 0
+
+    start = time.perf_counter()
+    for first in range(count + 1, transactions + 1, GENERATE_BATCH):
+        last = min(first + GENERATE_BATCH - 1, transactions)
+        sql.execute(
+            conn,
+            GENERATE_TRANSACTIONS,
+            {
+                "ledger_id": ledger_id,
+                "first": first,
+                "last": last,
+                "start": datetime(2020, 1, 1, tzinfo=timezone.utc),
+                "currencies": currencies,
+            },
+        )
+        conn.commit()
+        print(f"ledger {ledger_id}: {last} transactions", end="\r", flush=True)
+
+    if count < transactions:
+        conn.execute("ANALYZE transaction, entry, account, account_balance")
+        conn.commit()
+    print(f"ledger {ledger_id}: {name} ({time.perf_counter() - start:.1f} s)")
+    return ledger_id
+
+
+def summarize(seconds: list[float], elapsed: float, items: int) -> dict:
+    """
+    Summarize the request latencies (seconds) of a benchmark that processed the given
+    number of items (transactions, rows) in the elapsed time.
+    """
+    quantiles = (
+        statistics.quantiles(seconds, n=100) if len(seconds) > 1 else seconds * 99
+    )
+    return {
+        "requests": len(seconds),
+        "items_per_second": round(items / elapsed, 1),
+        "mean_ms": round(statistics.mean(seconds) * 1e3, 3),
+        "p50_ms": round(quantiles[49] * 1e3, 3),
+        "p95_ms": round(quantiles[94] * 1e3, 3),
+        "p99_ms": round(quantiles[98] * 1e3, 3),
+        "max_ms": round(max(seconds) * 1e3, 3),
+    }
+
+
+async def run(client: httpx.AsyncClient, requests, concurrency: int) -> dict:
+    """
+    Make the requests, given as (method, url, params, json, items) tuples, with the
+    given number of concurrent clients, and summarize them. `items` is the number of
+    items that a request processes, or None to count the (NDJSON) rows in the response.
+    """
+    queue = list(reversed(requests))
+    seconds, counts = [], []
+
+    async def worker():
+        while queue:
+            method, url, params, data, items = queue.pop()
+            start = time.perf_counter()
+            response = await client.request(method, url, params=params, json=data)
+            seconds.append(time.perf_counter() - start)
+            assert response.is_success, f"{method} {url}: {response.text}"
+            counts.append(
+                items if items is not None else len(response.content.splitlines())
+            )
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return summarize(seconds, time.perf_counter() - start, sum(counts))
+
+
+async def benchmark(args, ledger_id, accts: list, post_ledger_id, post_accts) -> dict:
+    """
+    Run the benchmarks: Reads from the synthetic ledger, posts to the posting ledger.
+    """
+    rng = random.Random(args.seed)
+    n = args.requests
+
+    def new_transaction():
+        dr, cr = rng.sample(post_accts, 2)
+        amount = f"{rng.randint(1, 100000) / 100:.2f}"
+        curr = rng.choice(args.currencies)
+        return {
+            "ledger_id": post_ledger_id,
+            "memo": "bench post",
+            "entries": [
+                {"acct": dr, "curr": curr, "dr": amount},
+                {"acct": cr, "curr": curr, "cr": amount},
+            ],
+        }
+
+    ledger = {"ledger": ledger_id}
+    benchmarks = {
+        "post_transaction": [
+            ("POST", "/api/transactions", None, new_transaction(), 1) for _ in range(n)
+        ],
+        "post_transactions_batch": [
+            (
+                "POST",
+                "/api/transactions/batch",
+                None,
+                [new_transaction() for _ in range(100)],
+                100,
+            )
+            for _ in range(max(n // 100, 1))
+        ],
+        "account_balances": [
+            (
+                "GET",
+                "/api/accounts/balances",
+                ledger | {"id": rng.choice(accts)},
+                None,
+                1,
+            )
+            for _ in range(n)
+        ],
+        "ledger_balances": [
+            ("GET", "/api/accounts/balances", ledger, None, 1)
+            for _ in range(max(n // 10, 1))
+        ],
+        "search_transactions_by_acct": [
+            ("GET", "/api/transactions", ledger | {"acct": rng.choice(accts)}, None, 1)
+            for _ in range(n)
+        ],
+        "search_transactions_by_memo": [
+            (
+                "GET",
+                "/api/transactions",
+                ledger | {"memo": f"^bench {rng.randint(1, args.transactions)}$"},
+                None,
+                1,
+            )
+            for _ in range(n)
+        ],
+        "account_register": [
+            ("GET", f"/api/accounts/{rng.choice(accts)}/register", None, None, 1)
+            for _ in range(n)
+        ],
+        "export_account": [
+            ("GET", f"/api/accounts/{rng.choice(accts)}/export", None, None, None)
+            for _ in range(max(n // 100, 1))
+        ],
+    }
+
+    results = {}
+    async with httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=app), base_url="http://bench", timeout=None
+    ) as client:
+        for name, requests in benchmarks.items():
+            if args.only and name not in args.only:
+                continue
+            results[name] = await run(client, requests, args.concurrency)
+            print(f"{name:>30}: {results[name]}")
+    return results
+
+
+def compare(results: dict, baseline: dict):
+    """
+    Print the change of each result from the baseline results (as from a previous
+    --output file).
+    """
+    print(f"\ncompared to {baseline.get('commit')} ({baseline.get('time')}):")
+    for name, result in results.items():
+        if name not in baseline["results"]:
+            continue
+        base = baseline["results"][name]
+        changes = [
+            f"{key} {(result[key] - base[key]) / base[key] * 100:+6.1f}%"
+            for key in ["items_per_second", "p50_ms", "p95_ms"]
+            if base.get(key)
+        ]
+        print(f"{name:>30}: {', '.join(changes)}")
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def main(args):
+    settings = DatabaseSettings()
+    sql = SQL(dialect=settings.dialect)
+    with psycopg_pool.ConnectionPool(
+        conninfo=settings.url.get_secret_value()
+    ) as dbpool:
+        with dbpool.connection() as conn:
+            ledger_id = generate_ledger(
+                sql, conn, args.accounts, args.transactions, args.currencies
+            )
+            post_ledger_id = create_ledger(
+                sql,
+                conn,
+                f"bench post {datetime.now(tz=timezone.utc).isoformat()}",
+                args.accounts,
+                args.currencies,
+            )
+            accts, post_accts = [
+                [
+                    row["id"]
+                    for row in sql.select(
+                        conn,
+                        "SELECT id FROM account WHERE ledger_id = :ledger_id ORDER BY id",
+                        {"ledger_id": id},
+                    )
+                ]
+                for id in [ledger_id, post_ledger_id]
+            ]
+
+    app.settings.auth.disabled = True
+    async with app.router.lifespan_context(app):
+        results = await benchmark(args, ledger_id, accts, post_ledger_id, post_accts)
+
+    output = {
+        "commit": git_commit(),
+        "time": datetime.now(tz=timezone.utc).isoformat(),
+        "params": {
+            key: getattr(args, key)
+            for key in [
+                "accounts",
+                "transactions",
+                "currencies",
+                "requests",
+                "concurrency",
+                "seed",
+            ]
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n\n")[0])
+    parser.add_argument("--accounts", type=int, default=1000)
+    parser.add_argument("--transactions", type=int, default=1_000_000)
+    parser.add_argument(
+        "--currencies", type=lambda val: val.split(","), default=["USD", "CAD", "EUR"]
+    )
+    parser.add_argument("--requests", type=int, default=1000, help="per benchmark")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--only", type=lambda val: val.split(","), help="run only these benchmarks"
+    )
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="compare with a previous --output file")
+    asyncio.run(main(parser.parse_args()))
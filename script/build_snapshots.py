@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+"""
+Build the monthly account balance snapshots that are used for point-in-time balances
+(GET /api/accounts/balances?as_of=...). Incremental by default: Builds the snapshots for
+the month boundaries after the latest existing snapshot, up to now. Each snapshot is
+built from the previous snapshot plus the entries since then, and committed separately.
+The snapshot for a month boundary includes the entries effective at exactly that instant
+(the periods are inclusive).
+
+Usage: script/build_snapshots.py [--rebuild] [--until YYYY-MM-DD]
+"""
+
+import argparse
+from datetime import datetime, timezone
+
+import psycopg_pool
+from sqly import SQL
+
+from blackledger.settings import DatabaseSettings
+
+
+def month_starts(start: datetime, until: datetime):
+    """
+    Yield the first instant of each month after `start`, up to and including `until`.
+    """
+    year, month = start.year, start.month
+    while True:
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+        period = datetime(year, month, 1, tzinfo=timezone.utc)
+        if period > until:
+            break
+        yield period
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n\n")[0])
+    parser.add_argument(
+        "--rebuild", action="store_true", help="delete and rebuild all the snapshots"
+    )
+    parser.add_argument(
+        "--until",
+        type=lambda val: datetime.fromisoformat(val).replace(tzinfo=timezone.utc),
+        default=datetime.now(tz=timezone.utc),
+        help="build the snapshots up to this date (default: now)",
+    )
+    args = parser.parse_args()
+
+    settings = DatabaseSettings()
+    sql = SQL(dialect=settings.dialect)
+    with psycopg_pool.ConnectionPool(
+        conninfo=settings.url.get_secret_value()
+    ) as dbpool:
+        with dbpool.connection() as conn:
+            if args.rebuild:
+                sql.execute(conn, "DELETE FROM account_balance_snapshot")
+            start = sql.select_one(
+                conn,
+                """
+                SELECT COALESCE(
+                    (SELECT max(period) FROM account_balance_snapshot),
+                    (SELECT min(effective) FROM transaction)
+                ) start
+                """,
+            )["start"]
+            conn.commit()
+
+            for period in month_starts(start, args.until) if start else []:
+                count = sql.select_one(
+                    conn,
+                    "SELECT account_balance_snapshot_build(:period) count",
+                    {"period": period},
+                )["count"]
+                conn.commit()
+                print(f"{period.isoformat()}: {count} balances")